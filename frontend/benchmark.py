@@ -0,0 +1,257 @@
+# Offline benchmarks for the datastore and sync code paths.
+#
+# Usage: python3 benchmark.py <name> [<name> ...]
+# Run with no arguments to list the available benchmarks.
+
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+import codec
+import datastore
+import fetch_pool
+import poller
+import search_index
+import scheduler
+import threading
+from models import UserTrack, UserPlaylist, UserArtist, UserAlbum
+
+def timed(fun, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fun()
+    return (time.perf_counter() - start) / repeat
+
+def report(label, seconds, size = None):
+    line = "  {:<24} {:>9.3f} ms".format(label, seconds * 1000.0)
+    if size is not None:
+        line += "  {:>9} bytes".format(size)
+    print(line)
+
+def sample_tracks(count, artists = 40, albums = 80):
+    return [UserTrack("Track number " + str(i), "Artist " + str(i % artists),
+        "Album " + str(i % albums), "spotify:track:" + str(i).rjust(22, '0')) for i in range(count)]
+
+def bench_codec():
+    """pickle vs codec for a 1000 track playlist and a single playlist entity"""
+    repeat = 50
+    for label, value in [("1000 track list", sample_tracks(1000)),
+                         ("playlist entity", UserPlaylist("Morning Commute", 3, "spotify:playlist:" + "1" * 22, 1000))]:
+        pickled = pickle.dumps(value)
+        encoded = codec.encode(value)
+        print(label)
+        report("pickle encode", timed(lambda: pickle.dumps(value), repeat), len(pickled))
+        report("codec encode", timed(lambda: codec.encode(value), repeat), len(encoded))
+        report("pickle decode", timed(lambda: pickle.loads(pickled), repeat))
+        report("codec decode", timed(lambda: codec.decode(encoded), repeat))
+
+def open_stores():
+    stores = []
+    try:
+        import redis
+        client = redis.Redis()
+        client.ping()
+        stores.append(("redis", client))
+    except Exception as e:
+        print("  redis unavailable, skipping (" + str(e) + ")")
+    path = os.path.join(tempfile.mkdtemp(), "library.db")
+    import sqlite_store
+    stores.append(("sqlite", sqlite_store.SqliteStore(path)))
+    return stores
+
+def bench_stores():
+    """redis vs sqlite backends: library sync, menu scrolling and now-playing lookups"""
+    playlists = [(UserPlaylist("Playlist " + str(i), i, "spotify:playlist:" + str(i).rjust(22, '0'), 100),
+        sample_tracks(100)) for i in range(200)]
+    for name, store in open_stores():
+        store.flushdb()
+        ds = datastore.Datastore(cache_bytes = 0, store = store)
+        print(name)
+        def sync():
+            with ds.refresh():
+                for page in range(0, 2000, 50):
+                    with ds.batch():
+                        for idx in range(page, page + 50):
+                            ds.setArtist(idx, UserArtist("Artist " + str(idx), "spotify:artist:" + str(idx)))
+                for page in range(0, len(playlists), 50):
+                    with ds.batch():
+                        for idx in range(page, page + 50):
+                            playlist, tracks = playlists[idx]
+                            ds.setPlaylist(playlist, tracks, index=idx)
+        report("sync 2000 artists/200 pl", timed(sync, 1))
+        report("scroll window (18 rows)", timed(lambda: [ds.getArtists(start, 18) for start in range(0, 1800, 6)], 1) / 300)
+        uris = [playlist.uri for playlist, _ in playlists]
+        report("open playlist window", timed(lambda: [ds.getPlaylistTrackRange(uri, 0, 18) for uri in uris], 1) / len(uris))
+        playing = [(playlist.uri, tracks[len(tracks) // 2].uri) for playlist, tracks in playlists]
+        report("now-playing lookup", timed(lambda: [(ds.getPlaylistUri(uri), ds.getTrackPosition(uri, track_uri))
+            for uri, track_uri in playing], 1) / len(playing))
+        store.flushdb()
+
+class StubCollection():
+    # Offset-paginated endpoint answering after a fixed round trip
+    def __init__(self, size, latency):
+        self.items = [{'track': {'name': "Track " + str(i)}} for i in range(size)]
+        self.latency = latency
+        self.calls = 0
+
+    def page(self, offset, limit = 50):
+        self.calls = self.calls + 1
+        time.sleep(self.latency)
+        return {'items': self.items[offset:offset + limit], 'offset': offset, 'limit': limit, 'total': len(self.items),
+            'next': offset + limit if offset + limit < len(self.items) else None}
+
+    def next(self, page):
+        return self.page(page['next'], page['limit'])
+
+def bench_pagination():
+    """serial vs parallel pagination of a 2000 item collection over a stubbed 60 ms API, at bulk priority"""
+    stub = StubCollection(2000, 0.06)
+    for workers in [1, 2, 4, 8]:
+        sched = scheduler.RequestScheduler()
+        pool = fetch_pool.FetchPool(workers, gate = sched.gate)
+        bulk = scheduler.ScheduledClient(stub, sched, scheduler.BULK)
+        def serial():
+            return [item for _, items in pool.pages(bulk.page, next_page=bulk.next) for item in items]
+        def parallel():
+            return [item for _, items in pool.pages(bulk.page) for item in items]
+        assert parallel() == stub.items
+        if workers == 1:
+            report("serial (sp.next)", timed(serial, 1))
+        report("parallel, " + str(workers) + " workers", timed(parallel, 1))
+
+MARKETS = ["AD", "AE", "AR", "AT", "AU", "BE", "BG", "BH", "BO", "BR", "CA", "CH", "CL", "CO", "CR", "CY", "CZ",
+    "DE", "DK", "DO", "DZ", "EC", "EE", "EG", "ES", "FI", "FR", "GB", "GR", "GT", "HK", "HN", "HU", "ID", "IE", "IL",
+    "IN", "IS", "IT", "JO", "JP", "KW", "LB", "LI", "LT", "LU", "LV", "MA", "MC", "MT", "MX", "MY", "NI", "NL", "NO",
+    "NZ", "OM", "PA", "PE", "PH", "PL", "PS", "PT", "PY", "QA", "RO", "SA", "SE", "SG", "SK", "SV", "TH", "TN", "TR",
+    "TW", "US", "UY", "VN", "ZA"]
+
+def full_track(i, markets = True):
+    # Shaped like a Web API track object, with or without its market arrays
+    artist = {"external_urls": {"spotify": "https://open.spotify.com/artist/" + str(i % 40).rjust(22, '0')},
+        "href": "https://api.spotify.com/v1/artists/" + str(i % 40).rjust(22, '0'), "id": str(i % 40).rjust(22, '0'),
+        "name": "Artist " + str(i % 40), "type": "artist", "uri": "spotify:artist:" + str(i % 40).rjust(22, '0')}
+    images = [{"height": size, "width": size, "url": "https://i.scdn.co/image/ab67616d0000b273" + str(i).rjust(24, '0')}
+        for size in [640, 300, 64]]
+    album = {"album_type": "album", "artists": [artist], "external_urls": {"spotify": "https://open.spotify.com/album/x"},
+        "href": "https://api.spotify.com/v1/albums/x", "id": str(i % 80).rjust(22, '0'), "images": images,
+        "name": "Album " + str(i % 80), "release_date": "2019-05-17", "release_date_precision": "day",
+        "total_tracks": 12, "type": "album", "uri": "spotify:album:" + str(i % 80).rjust(22, '0')}
+    track = {"album": album, "artists": [artist], "disc_number": 1, "duration_ms": 215000, "explicit": False,
+        "external_ids": {"isrc": "USUM71900000"}, "external_urls": {"spotify": "https://open.spotify.com/track/x"},
+        "href": "https://api.spotify.com/v1/tracks/x", "id": str(i).rjust(22, '0'), "is_local": False,
+        "name": "Track number " + str(i), "popularity": 57, "preview_url": "https://p.scdn.co/mp3-preview/x",
+        "track_number": 3, "type": "track", "uri": "spotify:track:" + str(i).rjust(22, '0')}
+    if markets:
+        album["available_markets"] = MARKETS
+        track["available_markets"] = MARKETS
+    else:
+        track["is_playable"] = True
+    return track
+
+def trimmed_track(i):
+    # What the fields filter leaves of it
+    track = full_track(i)
+    return {"name": track["name"], "uri": track["uri"], "artists": [{"name": track["artists"][0]["name"]}],
+        "album": {"name": track["album"]["name"]}}
+
+def bench_payloads():
+    """JSON bytes and parse time of a 50 track page: full, market-trimmed and fields-filtered"""
+    repeat = 20
+    for label, make in [("full page", lambda i: full_track(i)),
+                        ("market= page", lambda i: full_track(i, markets = False)),
+                        ("fields= page", trimmed_track)]:
+        body = json.dumps({"items": [{"added_at": "2021-01-01T00:00:00Z", "track": make(i)} for i in range(50)],
+            "limit": 50, "offset": 0, "total": 50, "next": None}).encode('utf-8')
+        report(label, timed(lambda: json.loads(body), repeat), len(body))
+
+def bench_scheduler():
+    """button press latency while a 2000 item sync is paced after a 429, FIFO vs prioritized"""
+    for label, interactive in [("fifo", scheduler.BULK), ("prioritized", scheduler.INTERACTIVE)]:
+        sched = scheduler.RequestScheduler(rate = 20, burst = 20)
+        stub = StubCollection(2000, 0.06)
+        pool = fetch_pool.FetchPool(8, gate = sched.gate)
+        bulk = scheduler.ScheduledClient(stub, sched, scheduler.BULK)
+        press = scheduler.ScheduledClient(stub, sched, interactive)
+        # Bulk requests are only paced for a while after a 429
+        sched.gate.back_off(0)
+        sync = threading.Thread(target=lambda: [page for page in pool.pages(bulk.page)])
+        sync.start()
+        time.sleep(0.5)
+        presses = [timed(lambda: press.page(0, 1), 1) for _ in range(5)]
+        sync.join()
+        report(label + " press", sum(presses) / len(presses))
+        for name, stats in sched.stats().items():
+            if stats['requests']:
+                print("    {:<12} {:>4} requests, wait avg {:.1f} ms, max {:.1f} ms".format(
+                    name, stats['requests'], stats['avg_wait_ms'], stats['max_wait_ms']))
+
+def simulate_polling(next_delay, hours = 1, latency = 0.15):
+    # Plays back to back tracks on a simulated clock; returns the number of
+    # polls and how late each track change was noticed
+    durations = [200, 245, 181, 310, 222, 197]
+    ends = []
+    end = 0
+    while end < hours * 3600:
+        end = end + durations[len(ends) % len(durations)]
+        ends.append(end)
+    def state(t):
+        track = next(i for i, end in enumerate(ends) if end > t)
+        start = ends[track - 1] if track else 0
+        return {'track_uri': str(track), 'is_playing': True, 'timestamp': t + latency,
+            'progress': (t - start) * 1000.0, 'duration': (ends[track] - start) * 1000.0}
+    t = 0.0
+    polls = 0
+    seen = None
+    staleness = []
+    while t < ends[-2]:
+        now_playing = state(t)
+        polls = polls + 1
+        if seen is not None and now_playing['track_uri'] != seen:
+            staleness.append(t + latency - ends[int(seen)])
+        seen = now_playing['track_uri']
+        t = t + latency + next_delay(now_playing, t + latency)
+    return polls / (t / 3600.0), staleness
+
+def bench_poller():
+    """now-playing polls per hour and title staleness at track changes, fixed 4 s loop vs track-end poller"""
+    adaptive = poller.NowPlayingPoller(None)
+    adaptive.fast_delay = None
+    for label, next_delay in [("4 s loop", lambda now_playing, now: 4), ("adaptive", adaptive.next_delay)]:
+        per_hour, staleness = simulate_polling(next_delay)
+        print("  {:<12} {:>6.0f} requests/hour, staleness avg {:.2f} s, max {:.2f} s".format(
+            label, per_hour, sum(staleness) / len(staleness), max(staleness)))
+
+def bench_search():
+    """local search index over a 10000 track library: build, load and per-keystroke queries"""
+    tracks = sample_tracks(10000, artists = 800, albums = 1500)
+    artists = [UserArtist("Artist " + str(i), "spotify:artist:" + str(i)) for i in range(800)]
+    albums = [UserAlbum("Album " + str(i), "Artist " + str(i % 800), 10, "spotify:album:" + str(i)) for i in range(1500)]
+    playlists = [UserPlaylist("Playlist " + str(i), i, "spotify:playlist:" + str(i), 50) for i in range(200)]
+    index = search_index.SearchIndex.build(tracks, artists, albums, playlists, [])
+    encoded = index.encode()
+    report("build", timed(lambda: search_index.SearchIndex.build(tracks, artists, albums, playlists, []), 3), len(encoded))
+    report("load", timed(lambda: search_index.SearchIndex.decode(encoded), 3))
+    query = "track number 42"
+    for length in range(1, len(query) + 1):
+        report("query '" + query[:length] + "'", timed(lambda: index.search(query[:length]), 10))
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'stores': bench_stores,
+    'pagination': bench_pagination,
+    'payloads': bench_payloads,
+    'scheduler': bench_scheduler,
+    'poller': bench_poller,
+    'search': bench_search,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    if not names:
+        for name, fun in BENCHMARKS.items():
+            print(name + ": " + fun.__doc__)
+    for name in names:
+        print("== " + name)
+        BENCHMARKS[name]()
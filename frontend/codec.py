@@ -0,0 +1,99 @@
+import marshal
+import pickle
+from array import array
+from models import UserDevice, UserTrack, UserAlbum, UserEpisode, UserShow, UserArtist, UserPlaylist
+
+# Compact encoding for the entities kept in the datastore.
+#
+#   b'SP' | format version | type tag | marshal(payload)
+#
+# A single entity's payload is the tuple of its fields. A list of entities is
+# stored column-wise: every all-string column is interned into a string table
+# and kept as an array of indices into it, so the artist and album names
+# repeated across a 1000 track playlist are stored once.
+#
+# When an entity's fields change, bump FORMAT_VERSION and add the new field
+# layout to SCHEMAS; values written with an older layout are decoded by field
+# name, with fields that did not exist yet set to None.
+
+MAGIC = b'SP'
+FORMAT_VERSION = 1
+MARSHAL_VERSION = 4
+
+TAG_EMPTY_LIST = 0
+TAG_LIST = 0x80
+
+SCHEMAS = {
+    1: {
+        1: (UserTrack, ('title', 'artist', 'album', 'uri')),
+        2: (UserPlaylist, ('name', 'idx', 'uri', 'track_count')),
+        3: (UserAlbum, ('name', 'artist', 'track_count', 'uri')),
+        4: (UserShow, ('name', 'publisher', 'episode_count', 'uri')),
+        5: (UserEpisode, ('name', 'publisher', 'show', 'uri')),
+        6: (UserDevice, ('id', 'name', 'is_active')),
+        7: (UserArtist, ('name', 'uri')),
+    },
+}
+
+_TAGS = {cls: (tag, fields) for tag, (cls, fields) in SCHEMAS[FORMAT_VERSION].items()}
+
+def is_legacy(data):
+    return not data.startswith(MAGIC)
+
+def _header(tag):
+    return MAGIC + bytes((FORMAT_VERSION, tag))
+
+def _encode_column(values):
+    # Raw columns are marshalled as lists, interned string columns as tuples
+    if not all(type(value) is str for value in values):
+        return list(values)
+    table = {}
+    indices = [table.setdefault(value, len(table)) for value in values]
+    typecode = 'H' if len(table) <= 0xFFFF else 'I'
+    return (tuple(table), typecode, array(typecode, indices).tobytes())
+
+def _decode_column(column):
+    if type(column) is list:
+        return column
+    strings, typecode, packed = column
+    indices = array(typecode)
+    indices.frombytes(packed)
+    return [strings[i] for i in indices]
+
+def encode(value):
+    if isinstance(value, list):
+        if len(value) == 0:
+            return _header(TAG_EMPTY_LIST)
+        tag, fields = _TAGS[type(value[0])]
+        columns = tuple(_encode_column([getattr(item, field) for item in value]) for field in fields)
+        return _header(TAG_LIST | tag) + marshal.dumps(columns, MARSHAL_VERSION)
+    tag, fields = _TAGS[type(value)]
+    row = tuple(getattr(value, field) for field in fields)
+    return _header(tag) + marshal.dumps(row, MARSHAL_VERSION)
+
+def _row_builder(version, tag):
+    cls, fields = SCHEMAS[version][tag]
+    if version == FORMAT_VERSION:
+        return lambda row: cls(*row)
+    current = SCHEMAS[FORMAT_VERSION][tag][1]
+    def build(row):
+        named = dict(zip(fields, row))
+        return cls(*[named.get(field) for field in current])
+    return build
+
+def decode(data):
+    if data is None:
+        return None
+    if is_legacy(data):
+        # Written before this format existed
+        return pickle.loads(data)
+    version, tag = data[2], data[3]
+    if version not in SCHEMAS:
+        raise ValueError("Unknown datastore format version: " + str(version))
+    if tag == TAG_EMPTY_LIST:
+        return []
+    payload = marshal.loads(data[4:])
+    build = _row_builder(version, tag & ~TAG_LIST)
+    if tag & TAG_LIST:
+        return [build(row) for row in zip(*[_decode_column(column) for column in payload])]
+    return build(payload)
@@ -0,0 +1,105 @@
+import threading
+import time
+
+# Playback commands from the click wheel, run one at a time on a single
+# long-lived worker. Presses that arrive while earlier ones are still
+# waiting are folded into them: consecutive skips in one direction become
+# a single skip by N, and a play/pause cancels a pending pause/play. When
+# the queue runs dry the idle callback runs once for the whole burst.
+#
+# A skip carries the playback state it was pressed in, so that the worker
+# can act on it even though the shown state has moved ahead in the meantime.
+# Behind a command that starts something else playing that state is stale,
+# so such a skip is sent as plain next/previous track requests instead.
+
+SKIP = 0
+PLAY_STATE = 1
+RUN = 2
+
+class CommandQueue():
+    def __init__(self, skip, set_playing, on_idle = lambda: None):
+        self.skip = skip
+        self.set_playing = set_playing
+        self.on_idle = on_idle
+        self.cond = threading.Condition()
+        self.pending = []
+        self.running = None
+        self.coalesced = 0
+        self.last_push = 0
+        self.last_done = 0
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def _run_ahead(self):
+        return self.running == RUN or any(command[0] == RUN for command in self.pending)
+
+    def has_run_ahead(self):
+        """True if a queued or running command may change what is playing"""
+        with self.cond:
+            return self._run_ahead()
+
+    def _push(self, kind, arg, state = None):
+        with self.cond:
+            if kind == SKIP and self._run_ahead():
+                state = None
+            last = self.pending[-1] if self.pending else None
+            if kind == SKIP and last and last[0] == SKIP and (last[1] > 0) == (arg > 0):
+                self.pending[-1] = (SKIP, last[1] + arg, last[2])
+                self.coalesced = self.coalesced + 1
+            elif kind == PLAY_STATE and last and last[0] == PLAY_STATE:
+                # Either undoes the pending one or repeats it
+                self.pending.pop()
+                if last[1] == arg:
+                    self.pending.append(last)
+                self.coalesced = self.coalesced + (1 if last[1] == arg else 2)
+            else:
+                self.pending.append((kind, arg, state))
+            self.last_push = time.time()
+            self.cond.notify()
+
+    def next(self, state = None):
+        self._push(SKIP, 1, state)
+
+    def previous(self, state = None):
+        self._push(SKIP, -1, state)
+
+    def play(self, playing):
+        self._push(PLAY_STATE, playing)
+
+    def submit(self, fun):
+        self._push(RUN, fun)
+
+    def _execute(self, kind, arg, state):
+        if kind == SKIP:
+            self.skip(arg, state)
+        elif kind == PLAY_STATE:
+            self.set_playing(arg)
+        else:
+            arg()
+
+    def is_settled(self, since):
+        """True if every command pushed so far had finished by since"""
+        with self.cond:
+            return self.last_push <= self.last_done <= since
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                kind, arg, state = self.pending.pop(0)
+                self.running = kind
+            try:
+                self._execute(kind, arg, state)
+            except Exception as e:
+                print("command failed: " + str(e))
+            with self.cond:
+                self.running = None
+                self.last_done = time.time()
+                idle = not self.pending
+            if idle:
+                try:
+                    self.on_idle()
+                except Exception as e:
+                    print("command failed: " + str(e))
@@ -1,177 +1,796 @@
-import redis
-import pickle
-from functools import lru_cache 
+import os
+import time
+import codec
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# Per-collection index structures, maintained on write so that counts and
+# listings never need a KEYS scan:
+#   <name>-index  hash   sort index -> item id
+#   <name>-ids    set    every stored item id (indexed or not)
+#   artists       hash   sort index -> encoded artist
+# Tracks are stored once per generation in the "track-entities" hash (uri ->
+# encoded track); saved tracks ("saved-tracks" hash, sort index -> uri, only
+# for the pages browsed so far, with the full count in "saved-track-total") and
+# playlist/album track lists ("playlist-tracks:<id>" lists of uris) only hold
+# uris, so any window of them can be resolved without decoding the rest.
+# Each list has a "playlist-positions:<id>" hash (track uri -> first position)
+# so the now-playing position is a single lookup.
+# Library keys are prefixed with the generation they were synced in ("g<N>:");
+# readers use the generation stored under "generation" while refresh() fills
+# the next one. Devices and bookkeeping keys are not generation-scoped.
+# Values are encoded with codec; bump SCHEMA_VERSION with a _migrate step
+# whenever the layout changes.
+SCHEMA_VERSION = 5
+READ_CACHE_BYTES = 4 * 1024 * 1024
+SNAPSHOT_RETRY_SECONDS = 1
+# How long the snapshot stays open after leaving it, for reads still on it
+SNAPSHOT_CLOSE_SECONDS = 30
+
+# Storage backend, chosen with SPOTIFYPOD_STORE: "redis" (the default) talks to
+# a local redis-server, "sqlite" keeps everything in SPOTIFYPOD_SQLITE_PATH.
+STORE = os.environ.get("SPOTIFYPOD_STORE", "redis")
+SQLITE_PATH = os.environ.get("SPOTIFYPOD_SQLITE_PATH", "library.db")
+# After every refresh the active library is also copied to this SQLite file,
+# which is browsed at boot if redis-server is not up yet.
+SNAPSHOT_PATH = os.environ.get("SPOTIFYPOD_SNAPSHOT_PATH", "library-snapshot.db")
+
+def open_store(store = STORE):
+    if store == "sqlite":
+        import sqlite_store
+        return sqlite_store.SqliteStore(SQLITE_PATH)
+    if store == "redis":
+        import redis
+        return redis.Redis()
+    raise ValueError("Unknown SPOTIFYPOD_STORE: " + store)
+
+LIBRARY_KEY_PATTERNS = ["playlist-uri:*", "playlist-tracks:*", "playlist-index", "playlist-ids",
+                        "album-uri:*", "album-index", "album-ids", "nr-uri:*", "nr-index", "nr-ids",
+                        "show-uri:*", "show-episodes:*", "show-index", "show-ids", "artists", "tracks"]
+
+WRITE_COMMANDS = ['set', 'incr', 'hset', 'hdel', 'sadd', 'srem', 'rpush', 'delete', 'rename']
+
+class ReplayLog():
+    # Wraps the snapshot store while the real one is down. Writes still go
+    # to the snapshot so that they can be read back, and are recorded to be
+    # replayed on the real store once it is up.
+    def __init__(self, store):
+        self.store = store
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if name not in WRITE_COMMANDS:
+            return attr
+        def write(*args, **kwargs):
+            with self.lock:
+                self.writes.append((name, args, kwargs))
+            return attr(*args, **kwargs)
+        return write
+
+    def pipeline(self, transaction = True):
+        return ReplayPipeline(self, self.store.pipeline(transaction))
+
+    def replay(self, store):
+        """Applies the writes recorded so far to store, in order"""
+        with self.lock:
+            writes, self.writes = self.writes, []
+        if len(writes) == 0:
+            return 0
+        pipe = store.pipeline(transaction=False)
+        for name, args, kwargs in writes:
+            getattr(pipe, name)(*args, **kwargs)
+        pipe.execute()
+        return len(writes)
+
+class ReplayPipeline():
+    # Records a pipeline's writes once it is executed
+    def __init__(self, log, pipe):
+        self.log = log
+        self.pipe = pipe
+        self.writes = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipe, name)
+        if name not in WRITE_COMMANDS:
+            return attr
+        def write(*args, **kwargs):
+            self.writes.append((name, args, kwargs))
+            return attr(*args, **kwargs)
+        return write
+
+    def execute(self):
+        result = self.pipe.execute()
+        with self.log.lock:
+            self.log.writes.extend(self.writes)
+        self.writes = []
+        return result
+
+class ReadCache():
+    """LRU cache of decoded datastore values, bounded by the encoded size of
+    what it holds rather than by entry count, so one 1000 track playlist
+    costs as much of the budget as it does in Redis."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return (False, None)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return (True, entry[0])
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes
+            }
 
 class Datastore():
-    def __init__(self):
+    def __init__(self, cache_bytes = READ_CACHE_BYTES, store = None, snapshot_path = SNAPSHOT_PATH):
         self.now_playing = None
-        self.r = redis.Redis()
+        self.r = store if store is not None else open_store()
+        self.cache = ReadCache(cache_bytes)
+        self._local = threading.local()
+        self.snapshot_path = snapshot_path
+        self.using_snapshot = False
+        # The background write after a refresh and the one at the end of a
+        # delta sync share the temporary file
+        self.snapshot_lock = threading.Lock()
+        self.store_ready = threading.Event()
+        self.store_ready.set()
+        if not self._isAvailable(self.r) and snapshot_path and os.path.exists(snapshot_path):
+            self._openSnapshot()
+        else:
+            self._migrate()
+        self.generation = int(self.r.get("generation") or 0)
+
+    def _isAvailable(self, store):
+        try:
+            return store.ping()
+        except Exception:
+            return False
+
+    def _openSnapshot(self):
+        # Serve reads from the last snapshot until the real store comes up
+        import sqlite_store
+        print("datastore unavailable, browsing library snapshot")
+        primary = self.r
+        self.r = ReplayLog(sqlite_store.SqliteStore(self.snapshot_path))
+        self.using_snapshot = True
+        self.store_ready.clear()
+        thread = threading.Thread(target=self._waitForStore, args=(primary,))
+        thread.daemon = True
+        thread.start()
+
+    def _waitForStore(self, primary):
+        while not self._isAvailable(primary):
+            time.sleep(SNAPSHOT_RETRY_SECONDS)
+        snapshot = self.r
+        self.r = primary
+        self._migrate()
+        generation = int(self.r.get("generation") or 0)
+        # Writes made on the snapshot only apply to the library it was a copy of
+        replay = snapshot.replay if generation == self.generation else lambda store: 0
+        self.generation = generation
+        self.using_snapshot = False
+        self.cache.clear()
+        replayed = replay(primary)
+        self.store_ready.set()
+        print("datastore available, left library snapshot, " + str(replayed) + " writes replayed")
+        def close():
+            # Reads and writes that were already on the snapshot have finished
+            replay(primary)
+            snapshot.store.close()
+        timer = threading.Timer(SNAPSHOT_CLOSE_SECONDS, close)
+        timer.daemon = True
+        timer.start()
+
+    def _generation(self):
+        # The generation this thread reads and writes: the shadow one inside
+        # refresh(), the active one everywhere else
+        shadow = getattr(self._local, 'generation', None)
+        return shadow if shadow is not None else self.generation
+
+    def _key(self, name):
+        return "g" + str(self._generation()) + ":" + name
+
+    @contextmanager
+    def refresh(self):
+        """Redirects this thread's reads and writes to a new, empty generation.
+        Other threads keep reading the active one until the block completes,
+        when the new generation is switched in with a single SET and the old
+        one is deleted in the background. If the block raises, the partial
+        generation is discarded and the active one is left untouched. While
+        the library snapshot is browsed, waits for the real store first."""
+        if not self.store_ready.is_set():
+            print("waiting for the datastore before refreshing")
+            self.store_ready.wait()
+        previous = self.generation
+        shadow = self.r.incr("generation-counter")
+        self._local.generation = shadow
+        try:
+            yield self
+        except:
+            self._local.generation = None
+            self._collectInBackground(shadow)
+            raise
+        self._local.generation = None
+        self.r.set("generation", shadow)
+        self.generation = shadow
+        self.cache.clear()
+        self._collectInBackground(previous, snapshot=True)
+
+    def _collectInBackground(self, generation, snapshot = False):
+        def collect():
+            self._collect(generation)
+            if snapshot:
+                self.writeSnapshot()
+        thread = threading.Thread(target=collect)
+        thread.daemon = True
+        thread.start()
+
+    def writeSnapshot(self):
+        """Copies the active library and the saved devices into a fresh SQLite
+        file and moves it over snapshot_path, so a reader never sees a
+        half-written snapshot."""
+        import sqlite_store
+        if not self.snapshot_path or self.using_snapshot or isinstance(self.r, sqlite_store.SqliteStore):
+            # The SQLite store already is a persistent snapshot
+            return
+        with self.snapshot_lock:
+            temp_path = self.snapshot_path + ".tmp"
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            snapshot = sqlite_store.SqliteStore(temp_path)
+            pipe = snapshot.pipeline()
+            generation = self.generation
+            keys = list(self.r.scan_iter("g" + str(generation) + ":*", count=500)) + \
+                list(self.r.scan_iter("device*", count=500)) + list(self.r.scan_iter("search-cache"))
+            for key in keys:
+                key_type = self.r.type(key)
+                if key_type == b'string':
+                    pipe.set(key, self.r.get(key))
+                elif key_type == b'hash':
+                    pipe.hset(key, mapping=self.r.hgetall(key))
+                elif key_type == b'set':
+                    pipe.sadd(key, *self.r.smembers(key))
+                elif key_type == b'list':
+                    pipe.rpush(key, *self.r.lrange(key, 0, -1))
+            pipe.set("generation", generation)
+            pipe.set("schema-version", SCHEMA_VERSION)
+            pipe.execute()
+            snapshot.close()
+            os.replace(temp_path, self.snapshot_path)
+
+    def _collect(self, generation):
+        pipe = self.r.pipeline(transaction=False)
+        for idx, key in enumerate(self.r.scan_iter("g" + str(generation) + ":*", count=500)):
+            pipe.unlink(key)
+            if (idx % 500 == 499):
+                pipe.execute()
+        pipe.execute()
+
+    def _moveIntoGeneration(self, generation):
+        pipe = self.r.pipeline(transaction=False)
+        for pattern in LIBRARY_KEY_PATTERNS:
+            for key in self.r.scan_iter(pattern):
+                pipe.rename(key, "g" + str(generation) + ":" + key.decode('utf-8'))
+        pipe.execute()
+
+    def _writer(self):
+        # Writes made inside batch() on this thread are buffered in its pipeline
+        pipe = getattr(self._local, 'pipe', None)
+        return pipe if pipe is not None else self.r
+
+    @contextmanager
+    def batch(self):
+        """Buffers every set* call made on this thread and flushes them in a
+        single pipeline round trip on exit. Nested batches join the outer one."""
+        if getattr(self._local, 'pipe', None) is not None:
+            yield self
+            return
+        self._local.pipe = self.r.pipeline(transaction=False)
+        self._local.written = []
+        try:
+            yield self
+            self._local.pipe.execute()
+        finally:
+            self._local.pipe = None
+            for key in self._local.written:
+                self.cache.invalidate(key)
+
+    def _invalidate(self, key):
+        # Inside a batch the write only lands on execute(), so drop the cached
+        # value again afterwards in case another thread re-read it meanwhile
+        self.cache.invalidate(key)
+        if getattr(self._local, 'pipe', None) is not None:
+            self._local.written.append(key)
+
+    def _migrate(self):
+        version = int(self.r.get("schema-version") or 0)
+        if version < 1:
+            self._buildIndexes()
+        if version < 2:
+            self._reencodeLegacyValues()
+        if version < 3:
+            self._moveIntoGeneration(0)
+        if version < 4:
+            self._normalizeTracks()
+        if version < 5:
+            self._buildTrackPositions()
+        if version < SCHEMA_VERSION:
+            self.r.set("schema-version", SCHEMA_VERSION)
+
+    def _buildIndexes(self):
+        # Libraries synced before the index structures existed still have
+        # the old flat keys; index them once so counts don't read as 0.
+        for name in ["playlist", "album", "nr", "show"]:
+            for key in self.r.keys(name + "-index:*"):
+                item_id = self.r.get(key)
+                self.r.hset(name + "-index", key.decode('utf-8').split(":")[-1], item_id)
+                self.r.delete(key)
+            for key in self.r.keys(name + "-uri:*"):
+                self.r.sadd(name + "-ids", key.decode('utf-8').split(":")[-1])
+        for old, new in [("artist:*", "artists"), ("track:*", "tracks")]:
+            for key in self.r.keys(old):
+                self.r.hset(new, key.decode('utf-8').split(":")[-1], self.r.get(key))
+                self.r.delete(key)
+        for key in self.r.keys("device:*"):
+            self.r.sadd("device-ids", key.decode('utf-8').split(":", 1)[-1])
+
+    def _reencodeLegacyValues(self):
+        # codec.decode() still reads pickles, but rewriting them once keeps
+        # the memory and decode time savings for libraries synced earlier.
+        pipe = self.r.pipeline(transaction=False)
+        for pattern in ["*-uri:*", "*-episodes:*", "playlist-tracks:*", "device:*"]:
+            for key in self.r.scan_iter(pattern):
+                value = self.r.get(key)
+                if value and codec.is_legacy(value):
+                    pipe.set(key, codec.encode(codec.decode(value)))
+        for name in ["artists", "tracks"]:
+            for field, value in self.r.hgetall(name).items():
+                if codec.is_legacy(value):
+                    pipe.hset(name, field, codec.encode(codec.decode(value)))
+        pipe.execute()
+
+    def _normalizeTracks(self):
+        # Split the encoded track lists of the active generation into shared
+        # track entities and uri lists
+        generation = int(self.r.get("generation") or 0)
+        prefix = "g" + str(generation) + ":"
+        pipe = self.r.pipeline(transaction=False)
+        for key in self.r.scan_iter(prefix + "playlist-tracks:*"):
+            tracks = codec.decode(self.r.get(key))
+            pipe.delete(key)
+            self._writeTracks(pipe, prefix + "track-entities", key, key.replace(b"playlist-tracks:", b"playlist-positions:"), tracks)
+        for index, encoded in self.r.hgetall(prefix + "tracks").items():
+            track = codec.decode(encoded)
+            pipe.hset(prefix + "track-entities", track.uri, codec.encode(track))
+            pipe.hset(prefix + "saved-tracks", index, track.uri)
+        pipe.delete(prefix + "tracks")
+        pipe.execute()
+
+    def _buildTrackPositions(self):
+        prefix = "g" + str(int(self.r.get("generation") or 0)) + ":"
+        pipe = self.r.pipeline(transaction=False)
+        for key in self.r.scan_iter(prefix + "playlist-tracks:*"):
+            uris = [uri.decode('utf-8') for uri in self.r.lrange(key, 0, -1)]
+            positions_key = prefix + "playlist-positions:" + key.decode('utf-8').split(":")[-1]
+            self._writeTrackPositions(pipe, positions_key, uris)
+        pipe.execute()
 
     def getPlaylistCount(self):
-        return len(self.r.keys("playlist-index:*"))
+        return self.r.hlen(self._key("playlist-index"))
 
     def getSavedTrackCount(self):
-        return len(self.r.keys("track:*"))
+        total = self.r.get(self._key("saved-track-total"))
+        return int(total) if total is not None else self.r.hlen(self._key("saved-tracks"))
 
     def getArtistCount(self):
-        return len(self.r.keys("artist:*"))
+        return self.r.hlen(self._key("artists"))
 
     def getAlbumCount(self):
-        return len(self.r.keys("album-index:*"))
+        return self.r.hlen(self._key("album-index"))
 
     def getNewReleasesCount(self):
-        return len(self.r.keys("nr-index:*"))
+        return self.r.hlen(self._key("nr-index"))
 
     def getShowsCount(self):
-        return len(self.r.keys("show-index:*"))
+        return self.r.hlen(self._key("show-index"))
+
+    def _read(self, key):
+        # Cached values are keyed by the full, generation-prefixed key
+        found, value = self.cache.get(key)
+        if found:
+            return value
+        encoded = self.r.get(key)
+        value = codec.decode(encoded)
+        self.cache.put(key, value, len(encoded) if encoded else 0)
+        return value
+
+    def _readIndex(self, name, index):
+        key = (self._key(name), str(index))
+        found, value = self.cache.get(key)
+        if found:
+            return value
+        item_id = self.r.hget(key[0], index)
+        value = item_id.decode('utf-8') if item_id is not None else None
+        self.cache.put(key, value, len(item_id) if item_id else 0)
+        return value
+
+    def _write(self, w, key, value):
+        w.set(key, codec.encode(value))
+        self._invalidate(key)
+
+    def _writeTracks(self, w, entities_key, key, positions_key, tracks):
+        w.delete(key)
+        if len(tracks) > 0:
+            w.hset(entities_key, mapping={track.uri: codec.encode(track) for track in tracks})
+            w.rpush(key, *[track.uri for track in tracks])
+        self._writeTrackPositions(w, positions_key, [track.uri for track in tracks])
+        self._invalidate(key)
+
+    def _writeTrackPositions(self, w, positions_key, uris):
+        positions = {}
+        for pos, uri in enumerate(uris):
+            positions.setdefault(uri, pos)
+        w.delete(positions_key)
+        if len(positions) > 0:
+            w.hset(positions_key, mapping=positions)
+
+    def _fetchTracks(self, uris):
+        uris = [uri for uri in uris if uri]
+        if len(uris) == 0:
+            return []
+        return [track for track in self.r.hmget(self._key("track-entities"), uris) if track]
+
+    def _resolveTracks(self, uris):
+        return [codec.decode(track) for track in self._fetchTracks(uris)]
+
+    def _readTrackRange(self, key, start, count):
+        pipe = self.r.pipeline(transaction=False)
+        pipe.lrange(key, start, start + count - 1)
+        pipe.llen(key)
+        uris, total = pipe.execute()
+        return (self._resolveTracks(uris), total)
+
+    def _writeIndex(self, w, name, index, item_id):
+        w.hset(self._key(name), index, item_id)
+        self._invalidate((self._key(name), str(index)))
 
     def setShow(self, show, episodes, index = -1):
+        w = self._writer()
         show_id = show.uri.split(":")[-1]
-        self.r.set("show-uri:"+str(show_id), pickle.dumps(show))
-        self.r.set("show-episodes:"+str(show_id), pickle.dumps(episodes))
+        self._write(w, self._key("show-uri:")+str(show_id), show)
+        self._write(w, self._key("show-episodes:")+str(show_id), episodes)
+        w.sadd(self._key("show-ids"), show_id)
         if(index > -1):
-            self.r.set("show-index:"+str(index), show_id)
+            self._writeIndex(w, "show-index", index, show_id)
 
     def setNewRelease(self, album, tracks, index = -1):
+        w = self._writer()
         album_id = album.uri.split(":")[-1]
-        self.r.set("nr-uri:"+str(album_id), pickle.dumps(album))
-        self.r.set("playlist-tracks:"+str(album_id), pickle.dumps(tracks))
+        self._write(w, self._key("nr-uri:")+str(album_id), album)
+        self._writeTracks(w, self._key("track-entities"), self._key("playlist-tracks:")+str(album_id),
+            self._key("playlist-positions:")+str(album_id), tracks)
+        w.sadd(self._key("nr-ids"), album_id)
         if (index > -1):
-            self.r.set("nr-index:"+str(index), album_id)
+            self._writeIndex(w, "nr-index", index, album_id)
 
     def setAlbum(self, album, tracks, index = -1):
+        w = self._writer()
         album_id = album.uri.split(":")[-1]
-        self.r.set("album-uri:"+str(album_id), pickle.dumps(album))
-        self.r.set("playlist-tracks:"+str(album_id), pickle.dumps(tracks))
+        self._write(w, self._key("album-uri:")+str(album_id), album)
+        self._writeTracks(w, self._key("track-entities"), self._key("playlist-tracks:")+str(album_id),
+            self._key("playlist-positions:")+str(album_id), tracks)
+        w.sadd(self._key("album-ids"), album_id)
         if (index > -1):
-            self.r.set("album-index:"+str(index), album_id)
+            self._writeIndex(w, "album-index", index, album_id)
 
-    def setPlaylist(self, playlist, tracks, index = -1):
+    def setPlaylist(self, playlist, tracks, index = -1, snapshot_id = None):
+        # tracks=None updates the playlist itself and keeps its stored tracks
+        w = self._writer()
         playlist_id = playlist.uri.split(":")[-1]
-        self.r.set("playlist-uri:"+str(playlist_id), pickle.dumps(playlist))
-        self.r.set("playlist-tracks:"+str(playlist_id), pickle.dumps(tracks))
+        self._write(w, self._key("playlist-uri:")+str(playlist_id), playlist)
+        if tracks is not None:
+            self._writeTracks(w, self._key("track-entities"), self._key("playlist-tracks:")+str(playlist_id),
+                self._key("playlist-positions:")+str(playlist_id), tracks)
+        if snapshot_id is not None:
+            w.hset(self._key("playlist-snapshots"), playlist_id, snapshot_id)
+        w.sadd(self._key("playlist-ids"), playlist_id)
         if (index > -1):
-            self.r.set("playlist-index:"+str(index), playlist_id)
+            self._writeIndex(w, "playlist-index", index, playlist_id)
+
+    def getPlaylistSnapshots(self):
+        """Returns {playlist id: Spotify snapshot_id its tracks were synced at}."""
+        return {playlist_id.decode('utf-8'): snapshot_id.decode('utf-8') for playlist_id, snapshot_id in
+            self.r.hgetall(self._key("playlist-snapshots")).items()}
+
+    def getIndexedIds(self, name):
+        """Returns the ids of an indexed collection ("playlist", "album", "nr"
+        or "show") in sort order."""
+        index = self.r.hgetall(self._key(name + "-index"))
+        return [index[field].decode('utf-8') for field in sorted(index, key=int)]
+
+    def getIndexedItems(self, name):
+        """Returns the items of an indexed collection in sort order."""
+        ids = self.getIndexedIds(name)
+        if len(ids) == 0:
+            return []
+        keys = [self._key(name + "-uri:") + item_id for item_id in ids]
+        return [codec.decode(item) for item in self.r.mget(keys) if item]
+
+    def setCollectionTotal(self, name, total):
+        """Records how many items a collection has at Spotify, when only the
+        first pages of it are stored."""
+        self._writer().set(self._key(name + "-total"), total)
+
+    def getCollectionTotal(self, name):
+        total = self.r.get(self._key(name + "-total"))
+        return int(total) if total is not None else None
+
+    def setIndexedIds(self, name, ids):
+        """Replaces the sort order of an indexed collection."""
+        w = self._writer()
+        key = self._key(name + "-index")
+        previous_count = self.r.hlen(key)
+        w.delete(key)
+        if len(ids) > 0:
+            w.hset(key, mapping=dict(enumerate(ids)))
+        for index in range(max(previous_count, len(ids))):
+            self._invalidate((key, str(index)))
+
+    def removeItem(self, name, item_id):
+        """Deletes a playlist, album, new release or show and its track or
+        episode list. Its sort index is left to setIndexedIds()."""
+        w = self._writer()
+        keys = [self._key(name + "-uri:") + item_id, self._key("show-episodes:") + item_id]
+        # A saved album and a new release with the same id share a track list
+        other = {"album": "nr-ids", "nr": "album-ids"}.get(name)
+        if other is None or not self.r.sismember(self._key(other), item_id):
+            keys = keys + [self._key("playlist-tracks:") + item_id, self._key("playlist-positions:") + item_id]
+        w.delete(*keys)
+        w.srem(self._key(name + "-ids"), item_id)
+        w.hdel(self._key("playlist-snapshots"), item_id)
+        for key in keys:
+            self._invalidate(key)
 
     def setArtist(self, index, artist):
-        self.r.set("artist:"+str(index), pickle.dumps(artist))
+        w = self._writer()
+        w.hset(self._key("artists"), index, codec.encode(artist))
     
-    @lru_cache(maxsize=50)
     def getShow(self, index):
-        show_uri = self.r.get("show-index:"+str(index))
-        if(show_uri is None):
+        show_id = self._readIndex("show-index", index)
+        if(show_id is None):
             return None
-        return self.getShowUri(show_uri.decode('utf-8'))
+        return self.getShowUri(show_id)
 
-    @lru_cache(maxsize=50)
     def getPlaylist(self, index):
-        playlist_uri = self.r.get("playlist-index:"+str(index))
-        if (playlist_uri is None):
+        playlist_id = self._readIndex("playlist-index", index)
+        if (playlist_id is None):
             return None
-        return self.getPlaylistUri(playlist_uri.decode('utf-8'))
+        return self.getPlaylistUri(playlist_id)
+
+    def setShowEpisodes(self, show_uri, episodes):
+        show_id = show_uri.split(":")[-1]
+        self._write(self._writer(), self._key("show-episodes:")+str(show_id), episodes)
 
     def getShowEpisodes(self, show_uri):
         show_id = show_uri.split(":")[-1]
-        pickled_sh = self.r.get("show-episodes:"+str(show_id))
-        if(pickled_sh is None):
-            return None
-        return pickle.loads(pickled_sh)
+        return self._read(self._key("show-episodes:")+str(show_id))
 
-    def getPlaylistTracks(self, playlist_uri):
+    def getTrackPosition(self, playlist_uri, track_uri):
+        """Returns (0-based position of track_uri or None, total track count)
+        for a playlist or album, without reading its track list."""
         playlist_id = playlist_uri.split(":")[-1]
-        pickled_pl = self.r.get("playlist-tracks:"+str(playlist_id))
-        if (pickled_pl is None):
-            return None
-        return pickle.loads(pickled_pl)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hget(self._key("playlist-positions:")+str(playlist_id), track_uri)
+        pipe.llen(self._key("playlist-tracks:")+str(playlist_id))
+        position, total = pipe.execute()
+        return (int(position) if position is not None else None, total)
+
+    def getPlaylistTrackRange(self, playlist_uri, start, count):
+        """Returns (tracks[start:start + count], total track count) of a playlist or album."""
+        playlist_id = playlist_uri.split(":")[-1]
+        return self._readTrackRange(self._key("playlist-tracks:")+str(playlist_id), start, count)
 
-    @lru_cache(maxsize=50)
     def getAlbum(self, index):
-        album_uri = self.r.get("album-index:"+str(index))
-        if (album_uri is None):
+        album_id = self._readIndex("album-index", index)
+        if (album_id is None):
             return None
-        return self.getAlbumUri(album_uri.decode('utf-8'))
+        return self.getAlbumUri(album_id)
 
-    @lru_cache(maxsize=50)
     def getNewRelease(self, index):
-        album_uri = self.r.get("nr-index:"+str(index))
-        if (album_uri is None):
+        album_id = self._readIndex("nr-index", index)
+        if (album_id is None):
             return None
-        return self.getNewReleaseUri(album_uri.decode('utf-8'))
+        return self.getNewReleaseUri(album_id)
 
-    @lru_cache(maxsize=50)
     def getShowUri(self, uri):
         show_id = str(uri).split(":")[-1]
-        pickled_sh = self.r.get("show-uri:"+str(show_id))
-        if(not pickled_sh):
-            return None
-        return pickle.loads(pickled_sh)
+        return self._read(self._key("show-uri:")+str(show_id))
 
-    @lru_cache(maxsize=50)
     def getPlaylistUri(self, uri):
         playlist_id = str(uri).split(":")[-1]
-        pickled_pl = self.r.get("playlist-uri:"+str(playlist_id))
-        if (not pickled_pl):
-            return None
-        return pickle.loads(pickled_pl)
+        return self._read(self._key("playlist-uri:")+str(playlist_id))
 
-    @lru_cache(maxsize=50)
     def getAlbumUri(self, uri):
         album_id = str(uri).split(":")[-1]
-        pickled_pl = self.r.get("album-uri:"+str(album_id))
-        if (not pickled_pl):
-            return None
-        return pickle.loads(pickled_pl)
+        return self._read(self._key("album-uri:")+str(album_id))
 
-    @lru_cache(maxsize=50)
     def getNewReleaseUri(self, uri):
         album_id = str(uri).split(":")[-1]
-        pickled_pl = self.r.get("nr-uri:"+str(album_id))
-        if (not pickled_pl):
-            return None
-        return pickle.loads(pickled_pl)
-
-    def getArtist(self, index):
-        pickled_pl = self.r.get("artist:"+str(index))
-        return pickle.loads(pickled_pl)
-
-    def setSavedTrack(self, index, track):
-        self.r.set("track:"+str(index), pickle.dumps(track))
-
-    def getSavedTrack(self, index):
-        pickled_pl = self.r.get("track:"+str(index))
-        return pickle.loads(pickled_pl)
+        return self._read(self._key("nr-uri:")+str(album_id))
+
+    def _getRange(self, name, start, count):
+        # One round trip for both the window and the collection size
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hmget(name, list(range(start, start + count)))
+        pipe.hlen(name)
+        items, total = pipe.execute()
+        return ([codec.decode(item) for item in items if item], total)
+
+    def getArtists(self, start, count):
+        """Returns (artists[start:start + count], total artist count)."""
+        return self._getRange(self._key("artists"), start, count)
+
+    def getSavedTrackUris(self, start, count):
+        if count <= 0:
+            return []
+        uris = self.r.hmget(self._key("saved-tracks"), list(range(start, start + count)))
+        return [uri.decode('utf-8') if uri else None for uri in uris]
+
+    def setSavedTracks(self, start, tracks, total):
+        """Stores one page of saved tracks. total is the saved track count
+        at Spotify, most of which may not be stored."""
+        w = self._writer()
+        if len(tracks) > 0:
+            w.hset(self._key("track-entities"), mapping={track.uri: codec.encode(track) for track in tracks})
+            w.hset(self._key("saved-tracks"), mapping={start + i: track.uri for i, track in enumerate(tracks)})
+        w.set(self._key("saved-track-total"), total)
+
+    def clearSavedTracks(self):
+        w = self._writer()
+        w.delete(self._key("saved-tracks"))
+        w.delete(self._key("saved-track-total"))
+
+    def clearArtists(self):
+        self._writer().delete(self._key("artists"))
+
+    def getSavedTracks(self, start, count):
+        """Returns (tracks[start:start + count], total saved track count).
+        Saved tracks are stored a page at a time as they are browsed, so
+        tracks not stored yet are None, and total is None if nothing is."""
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hmget(self._key("saved-tracks"), list(range(start, start + count)))
+        pipe.get(self._key("saved-track-total"))
+        pipe.hlen(self._key("saved-tracks"))
+        uris, total, stored = pipe.execute()
+        # Libraries synced before paging stored every saved track
+        total = int(total) if total is not None else (stored or None)
+        if total is None:
+            return ([], None)
+        uris = uris[:max(0, total - start)]
+        present = [uri for uri in uris if uri]
+        encoded = dict(zip(present, self.r.hmget(self._key("track-entities"), present))) if present else {}
+        return ([codec.decode(encoded[uri]) if encoded.get(uri) else None for uri in uris], total)
+
+    def getAllTracks(self):
+        """Every stored track entity, saved or in any playlist or album."""
+        return [codec.decode(track) for track in self.r.hgetall(self._key("track-entities")).values()]
+
+    def getAllArtists(self):
+        artists = self.r.hgetall(self._key("artists"))
+        return [codec.decode(artists[field]) for field in sorted(artists, key=int)]
+
+    def setSearchIndex(self, data):
+        self._writer().set(self._key("search-index"), data)
+
+    def getSearchIndex(self):
+        # Read past the cache, the index is loaded once per sync anyway
+        return self.r.get(self._key("search-index"))
+
+    def getSearchCache(self):
+        cache = self.r.hgetall("search-cache")
+        return {query.decode('utf-8'): data for query, data in cache.items()}
+
+    def setSearchCacheEntry(self, query, data):
+        self._writer().hset("search-cache", query, data)
+
+    def removeSearchCacheEntries(self, queries):
+        self._writer().hdel("search-cache", *queries)
 
     def setUserDevice(self, device):
+        w = self._writer()
         print("device:"+ str(device.id))
-        self.r.set("device:"+ str(device.id), pickle.dumps(device))
+        w.set("device:"+ str(device.id), codec.encode(device))
+        w.sadd("device-ids", device.id)
 
     def getSavedDevice(self, id):
         return self._getSavedItem("device:"+id)
 
     def _getSavedItem(self, id):
-        pickled_device = self.r.get(id)
-        return pickle.loads(pickled_device)
+        encoded_device = self.r.get(id)
+        return codec.decode(encoded_device)
+
+    def _getAllSavedItems(self, name):
+        ids = self.r.smembers(self._key(name + "-ids"))
+        if (len(ids) == 0):
+            return []
+        keys = [self._key(name + "-uri:") + item_id.decode('utf-8') for item_id in ids]
+        return [codec.decode(item) for item in self.r.mget(keys) if item]
 
     def getAllSavedDevices(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("device:*")))
+        ids = self.r.smembers("device-ids")
+        if (len(ids) == 0):
+            return []
+        keys = ["device:" + device_id.decode('utf-8') for device_id in ids]
+        return [codec.decode(item) for item in self.r.mget(keys) if item]
 
     def getAllSavedPlaylists(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("playlist-uri:*")))
+        return self._getAllSavedItems("playlist")
 
     def getAllSavedAlbums(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("album-uri:*")))
+        return self._getAllSavedItems("album")
 
     def getAllNewReleases(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("nr-uri:*")))
+        return self._getAllSavedItems("nr")
 
     def getAllSavedShows(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("show-uri:*")))
+        return self._getAllSavedItems("show")
 
     def clearDevices(self):
-        devices = self.r.keys("device:*")
-        if (len(devices) == 0):
+        ids = self.r.smembers("device-ids")
+        if (len(ids) == 0):
             return
-        self.r.delete(*devices)
+        self.r.delete("device-ids", *["device:" + device_id.decode('utf-8') for device_id in ids])
 
     def clear(self):
-        self.r.flushdb()
\ No newline at end of file
+        self.r.flushdb()
+        self.r.set("schema-version", SCHEMA_VERSION)
+        self.generation = 0
+        self.cache.clear()
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from spotipy.exceptions import SpotifyException
+
+# Bounded worker pool for the per-item Spotify fetches of a library sync
+# (playlist tracks, albums). A 429 seen by any worker pauses all of them for
+# the Retry-After the API asked for, instead of every worker finding out
+# separately.
+
+FETCH_WORKERS = int(os.environ.get("SPOTIFYPOD_FETCH_WORKERS", "4"))
+MAX_RATE_LIMIT_RETRIES = 5
+DEFAULT_RETRY_AFTER = 1
+
+class RateLimitGate():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resume_at = 0
+
+    def wait(self):
+        while True:
+            with self.lock:
+                delay = self.resume_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def remaining(self):
+        with self.lock:
+            return max(0, self.resume_at - time.time())
+
+    def resumed_ago(self):
+        # Seconds since the last back-off ended, negative while it lasts
+        with self.lock:
+            return time.time() - self.resume_at
+
+    def back_off(self, seconds):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.time() + seconds)
+
+def retry_after(error):
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After', DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+class FetchPool():
+    def __init__(self, workers = FETCH_WORKERS, gate = None):
+        self.workers = max(1, workers)
+        self.gate = gate if gate is not None else RateLimitGate()
+        self.local = threading.local()
+
+    def call(self, fun, *args):
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            self.gate.wait()
+            try:
+                return fun(*args)
+            except SpotifyException as e:
+                if e.http_status != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise
+                print("rate limited, backing off " + str(retry_after(e)) + "s")
+                self.gate.back_off(retry_after(e))
+
+    def _run(self, fun, item):
+        self.local.in_worker = True
+        return self.call(fun, item)
+
+    def imap(self, fun, items):
+        """Yields fun(item) for every item, in order, fetched concurrently.
+        Called from inside one of the pool's own workers it runs serially,
+        so nested fetches never exceed the pool's concurrency."""
+        items = list(items)
+        if self.workers == 1 or len(items) < 2 or getattr(self.local, 'in_worker', False):
+            for item in items:
+                yield self.call(fun, item)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as executor:
+            for result in executor.map(lambda item: self._run(fun, item), items):
+                yield result
+
+    def pages(self, fetch, key = None, next_page = None):
+        """Yields (offset, items) for every page of an offset-paginated
+        collection, fetching the pages after the first concurrently. With
+        next_page the pages are instead followed one after the other."""
+        results = self.call(fetch, 0)
+        page = results[key] if key else results
+        yield (0, page['items'])
+        if next_page:
+            offset = len(page['items'])
+            while page['next']:
+                results = self.call(next_page, page)
+                page = results[key] if key else results
+                yield (offset, page['items'])
+                offset = offset + len(page['items'])
+            return
+        if not page['next']:
+            return
+        offsets = range(page['offset'] + page['limit'], page['total'], page['limit'])
+        for offset, results in zip(offsets, self.imap(fetch, offsets)):
+            page = results[key] if key else results
+            yield (offset, page['items'])
+
+    def map(self, fun, items):
+        """Returns [fun(item) for item in items], fetched concurrently."""
+        return list(self.imap(fun, items))
@@ -0,0 +1,74 @@
+import threading
+import time
+
+# Searches while the query is being picked letter by letter. Each change
+# gets a sequence number and restarts a short idle timer; only the newest
+# query is searched, one at a time on a single worker. A search that is
+# already running when a newer query comes in can't be stopped, but its
+# results are dropped instead of replacing the newer ones.
+#
+# Stages run in order and each delivers its results as soon as it is done,
+# e.g. the instant local index lookup before the remote search.
+
+DEBOUNCE_SECONDS = 0.35
+
+class LiveSearch():
+    def __init__(self, stages, on_results, delay = DEBOUNCE_SECONDS):
+        # stages: search functions query -> results, cheapest first.
+        # on_results(seq, query, results, done) gets every stage's results
+        # while seq is still the newest.
+        self.stages = stages
+        self.on_results = on_results
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.query = None
+        self.due = 0
+        self.searched = 0
+        self.discarded = 0
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def update(self, query, delay = None):
+        """Searches query once nothing newer arrives for delay seconds.
+        Returns its sequence number."""
+        with self.cond:
+            self.seq = self.seq + 1
+            self.query = query
+            self.due = time.monotonic() + (self.delay if delay is None else delay)
+            self.cond.notify()
+            return self.seq
+
+    def is_current(self, seq):
+        with self.cond:
+            return seq == self.seq
+
+    def _next(self):
+        with self.cond:
+            while True:
+                if self.query is None:
+                    self.cond.wait()
+                    continue
+                wait = self.due - time.monotonic()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+            seq, query = self.seq, self.query
+            self.query = None
+            return (seq, query)
+
+    def run(self):
+        while True:
+            seq, query = self._next()
+            self.searched = self.searched + 1
+            for i, stage in enumerate(self.stages):
+                try:
+                    results = stage(query)
+                except Exception as e:
+                    print("search failed: " + str(e))
+                    results = None
+                if not self.is_current(seq):
+                    self.discarded = self.discarded + 1
+                    break
+                self.on_results(seq, query, results, i == len(self.stages) - 1)
@@ -0,0 +1,70 @@
+class UserDevice():
+    __slots__ = ['id', 'name', 'is_active']
+    def __init__(self, id, name, is_active):
+        self.id = id
+        self.name = name
+        self.is_active = is_active
+
+class UserTrack():
+    __slots__ = ['title', 'artist', 'album', 'uri']
+    def __init__(self, title, artist, album, uri):
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.uri = uri
+
+    def __str__(self):
+        return self.title + " - " + self.artist + " - " + self.album
+
+class UserAlbum():
+    __slots__ = ['name', 'artist', 'track_count', 'uri']
+    def __init__(self, name, artist, track_count, uri):
+        self.name = name
+        self.artist = artist
+        self.uri = uri
+        self.track_count = track_count
+
+    def __str__(self):
+        return self.name + " - " + self.artist
+
+class UserEpisode():
+    __slots__ = ['name', 'publisher', 'show', 'uri']
+    def __init__(self, name, publisher, show, uri):
+        self.name = name
+        self.publisher = publisher
+        self.show = show
+        self.uri = uri
+
+    def __str__(self):
+        return self.name + " - " + self.publisher
+
+class UserShow():
+    __slots__ = ['name', 'publisher', 'episode_count', 'uri']
+    def __init__(self, name, publisher, episode_count, uri):
+        self.name = name
+        self.publisher = publisher
+        self.episode_count = episode_count
+        self.uri = uri
+
+    def __str__(self):
+        return self.name + " - " + self.publisher
+
+class UserArtist():
+    __slots__ = ['name', 'uri']
+    def __init__(self, name, uri):
+        self.name = name
+        self.uri = uri
+
+    def __str__(self):
+        return self.name
+
+class UserPlaylist(): 
+    __slots__ = ['name', 'idx', 'uri', 'track_count']
+    def __init__(self, name, idx, uri, track_count):
+        self.name = name
+        self.idx = idx
+        self.uri = uri
+        self.track_count = track_count
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,162 @@
+import threading
+import time
+
+# A long Spotify collection that is only downloaded where it is browsed.
+# Pages come from the datastore when they were fetched before, otherwise
+# from Spotify, and are kept in memory around the cursor: the pages next to
+# it are prefetched in the background and pages far from it are dropped.
+# Rendering never waits on Spotify: a page that isn't stored shows as empty
+# rows until the worker has fetched it, and a failed fetch is retried only
+# after RETRY_SECONDS.
+
+PAGE_SIZE = 50
+PREFETCH_PAGES = 1
+KEEP_PAGES = 4
+RETRY_SECONDS = 10
+
+class PagedCollection():
+    def __init__(self, cached, fetch, store, page_size = PAGE_SIZE, prefetch_pages = PREFETCH_PAGES, keep_pages = KEEP_PAGES):
+        # cached(start, count) -> (items, total) from the datastore, with None
+        # for items not fetched yet and total None when nothing is known.
+        # fetch(start, count, background) -> (items, total) from Spotify.
+        # store(start, items, total) writes a fetched page to the datastore.
+        self.cached = cached
+        self.fetch = fetch
+        self.store = store
+        self.page_size = page_size
+        self.prefetch_pages = prefetch_pages
+        self.keep_pages = keep_pages
+        self.cond = threading.Condition()
+        self.pages = {}
+        self.total = None
+        self.wanted = []
+        self.loading = set()
+        self.cursor = 0
+        self.retry_at = 0
+        self.cache_loads = 0
+        self.fetches = 0
+        self.prefetches = 0
+        self.evictions = 0
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def reset(self):
+        """Forgets the pages in memory, after the stored collection changed"""
+        with self.cond:
+            self.pages = {}
+            self.total = None
+            self.wanted = []
+
+    def _keep(self, page, items, total):
+        with self.cond:
+            if self.total is not None and total != self.total:
+                # Items were added or removed, the other pages have shifted
+                self.pages = {}
+            self.pages[page] = items
+            self.total = total
+
+    def _stored(self, page):
+        # The page from the datastore if all of it is stored, else None
+        start = page * self.page_size
+        items, total = self.cached(start, self.page_size)
+        if total is None or None in items or len(items) != min(self.page_size, max(0, total - start)):
+            with self.cond:
+                if self.total is None:
+                    self.total = total
+            return None
+        self.cache_loads = self.cache_loads + 1
+        self._keep(page, items, total)
+        return items
+
+    def _want(self, page):
+        # Queues a page for the worker, ahead of the prefetches
+        with self.cond:
+            if page in self.pages or page in self.loading:
+                return
+            if page in self.wanted:
+                self.wanted.remove(page)
+            self.wanted.insert(0, page)
+            self.cond.notify()
+
+    def _load(self, page, background):
+        # On the worker: the datastore, else Spotify
+        if self._stored(page) is not None:
+            return
+        start = page * self.page_size
+        try:
+            items, total = self.fetch(start, self.page_size, background)
+        except Exception as e:
+            print("page fetch failed: " + str(e))
+            with self.cond:
+                self.retry_at = time.time() + RETRY_SECONDS
+            return
+        self.store(start, items, total)
+        if background:
+            self.prefetches = self.prefetches + 1
+        else:
+            self.fetches = self.fetches + 1
+        self._keep(page, items, total)
+
+    def total_size(self):
+        """The collection's size, 0 until anything about it is known"""
+        with self.cond:
+            total = self.total
+        if total is None and self._stored(0) is None:
+            self._want(0)
+        with self.cond:
+            return self.total or 0
+
+    def item_at(self, index):
+        """The item at index, or None while its page is being fetched. Never
+        waits on Spotify, pages not stored are fetched by the worker."""
+        page = index // self.page_size
+        with self.cond:
+            items = self.pages.get(page)
+        if items is None:
+            items = self._stored(page)
+            if items is None:
+                self._want(page)
+        self._around(page)
+        offset = index - page * self.page_size
+        return items[offset] if items is not None and offset < len(items) else None
+
+    def _around(self, page):
+        # Drops far pages and queues the neighbours of page for prefetch
+        with self.cond:
+            self.cursor = page
+            for far in [p for p in self.pages if abs(p - page) > self.keep_pages]:
+                del self.pages[far]
+                self.evictions = self.evictions + 1
+            last = (self.total - 1) // self.page_size if self.total else 0
+            near = [page + d for d in range(1, self.prefetch_pages + 1)] + [page - d for d in range(1, self.prefetch_pages + 1)]
+            wanted = [p for p in self.wanted if abs(p - page) <= self.keep_pages]
+            wanted = wanted + [p for p in near if 0 <= p <= last and p not in wanted and p not in self.pages and p not in self.loading]
+            self.wanted = wanted
+            if self.wanted:
+                self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'pages': len(self.pages),
+                'cache_loads': self.cache_loads,
+                'fetches': self.fetches,
+                'prefetches': self.prefetches,
+                'evictions': self.evictions,
+            }
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.wanted or time.time() < self.retry_at:
+                    self.cond.wait(max(0, self.retry_at - time.time()) if self.wanted else None)
+                page = self.wanted.pop(0)
+                self.loading.add(page)
+                # Only the page under the cursor is being waited for
+                background = page != self.cursor
+            try:
+                self._load(page, background)
+            finally:
+                with self.cond:
+                    self.loading.discard(page)
@@ -0,0 +1,103 @@
+import threading
+import time
+
+# Decides when to ask Spotify what's playing. While a track plays the next
+# poll is timed for just after its predicted end, with a rare steady poll
+# in between to catch changes made from other devices. User commands switch
+# to fast polling until the result shows up, and nothing is polled while
+# the screen is asleep.
+
+FAST_INTERVAL = 0.4
+FAST_LIMIT = 4
+TRACK_END_MARGIN = 0.75
+MIN_INTERVAL = 1
+PLAYING_INTERVAL = 30
+PAUSED_INTERVAL = 15
+IDLE_INTERVAL = 60
+
+def remaining_seconds(now_playing, now):
+    elapsed = (now - now_playing['timestamp']) * 1000.0 if now_playing['is_playing'] else 0
+    return (now_playing['duration'] - now_playing['progress'] - elapsed) / 1000.0
+
+def track_end(now_playing):
+    return now_playing['timestamp'] + (now_playing['duration'] - now_playing['progress']) / 1000.0
+
+class NowPlayingPoller():
+    def __init__(self, poll):
+        # poll() fetches and returns the current now_playing
+        self.poll = poll
+        self.awake = threading.Event()
+        self.awake.set()
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.fast_delay = FAST_INTERVAL
+        self.requests = 0
+        self.awake_seconds = 0.0
+        self.track_changes = 0
+        self.total_staleness = 0.0
+        self.max_staleness = 0.0
+
+    def start(self):
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def boost(self):
+        """Polls now and then quickly for a while, after a user command"""
+        with self.lock:
+            self.fast_delay = FAST_INTERVAL
+        self.wake.set()
+
+    def sleep(self):
+        self.awake.clear()
+
+    def wake_up(self):
+        self.awake.set()
+        self.boost()
+
+    def next_delay(self, now_playing, now):
+        with self.lock:
+            if self.fast_delay is not None:
+                delay = self.fast_delay
+                self.fast_delay = self.fast_delay * 2 if self.fast_delay * 2 <= FAST_LIMIT else None
+                return delay
+        if not now_playing:
+            return IDLE_INTERVAL
+        if not now_playing['is_playing']:
+            return PAUSED_INTERVAL
+        return max(MIN_INTERVAL, min(PLAYING_INTERVAL, remaining_seconds(now_playing, now) + TRACK_END_MARGIN))
+
+    def record(self, before, after, now):
+        # Staleness: how long after the previous track should have ended the
+        # new one was noticed. Only for changes the user didn't cause here.
+        self.requests = self.requests + 1
+        if not before or not after or before['track_uri'] == after['track_uri']:
+            return
+        if not before['is_playing'] or self.fast_delay is not None:
+            return
+        staleness = max(0.0, now - track_end(before))
+        self.track_changes = self.track_changes + 1
+        self.total_staleness = self.total_staleness + staleness
+        self.max_staleness = max(self.max_staleness, staleness)
+
+    def stats(self):
+        hours = self.awake_seconds / 3600.0
+        return {
+            'requests': self.requests,
+            'requests_per_hour': self.requests / hours if hours else 0.0,
+            'track_changes': self.track_changes,
+            'avg_staleness_s': self.total_staleness / self.track_changes if self.track_changes else 0.0,
+            'max_staleness_s': self.max_staleness,
+        }
+
+    def run(self):
+        before = None
+        while True:
+            self.awake.wait()
+            started = time.time()
+            after = self.poll()
+            self.record(before, after, time.time())
+            before = after
+            self.wake.wait(self.next_delay(after, time.time()))
+            self.wake.clear()
+            self.awake_seconds = self.awake_seconds + time.time() - started
@@ -0,0 +1,114 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from fetch_pool import RateLimitGate
+
+# Every Spotify request asks the scheduler for a turn before it goes out.
+# Turns are handed out by priority, then arrival, so a button press queued
+# behind a library sync goes out next instead of after it. Everything waits
+# while a 429's Retry-After is in effect. Bulk requests are otherwise only
+# held back while a more urgent one is waiting, and for RECOVERY_SECONDS
+# after a 429, when they are paced by a token bucket shared by the whole
+# app and leave a few tokens in it for interactive ones.
+
+INTERACTIVE = 0
+POLL = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", POLL: "poll", BULK: "bulk"}
+
+RATE_PER_SECOND = float(os.environ.get("SPOTIFYPOD_BULK_RATE", "10"))
+BURST = 10
+RECOVERY_SECONDS = 30
+INTERACTIVE_RESERVE = 3
+
+class PriorityStats():
+    __slots__ = ['queued', 'requests', 'total_wait', 'max_wait']
+    def __init__(self):
+        self.queued = 0
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+class RequestScheduler():
+    def __init__(self, rate = RATE_PER_SECOND, burst = BURST, reserve = INTERACTIVE_RESERVE, recovery = RECOVERY_SECONDS, gate = None):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = min(reserve, burst - 1)
+        self.recovery = recovery
+        self.gate = gate if gate is not None else RateLimitGate()
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.order = itertools.count()
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.priority_stats = {priority: PriorityStats() for priority in PRIORITY_NAMES}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self, priority, now):
+        # Seconds until a request of this priority may go out
+        token_delay = 0
+        if priority == BULK and self.rate > 0 and self.gate.resumed_ago() < self.recovery:
+            token_delay = max(0, 1 + self.reserve - self.tokens) / self.rate
+        return max(token_delay, self.gate.remaining())
+
+    def acquire(self, priority):
+        start = time.monotonic()
+        ticket = (priority, next(self.order))
+        stats = self.priority_stats[priority]
+        with self.cond:
+            heapq.heappush(self.waiting, ticket)
+            stats.queued = stats.queued + 1
+            # A more urgent ticket may now be at the head
+            self.cond.notify_all()
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.waiting[0] == ticket:
+                    delay = self._delay(priority, now)
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                else:
+                    self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.tokens = max(0, self.tokens - 1)
+            wait = time.monotonic() - start
+            stats.queued = stats.queued - 1
+            stats.requests = stats.requests + 1
+            stats.total_wait = stats.total_wait + wait
+            stats.max_wait = max(stats.max_wait, wait)
+            self.cond.notify_all()
+
+    def call(self, priority, fun, *args, **kwargs):
+        self.acquire(priority)
+        return fun(*args, **kwargs)
+
+    def stats(self):
+        """Queue depth and wait times (ms) per priority"""
+        with self.cond:
+            return {PRIORITY_NAMES[priority]: {
+                'queued': stats.queued,
+                'requests': stats.requests,
+                'avg_wait_ms': 1000.0 * stats.total_wait / stats.requests if stats.requests else 0.0,
+                'max_wait_ms': 1000.0 * stats.max_wait,
+            } for priority, stats in self.priority_stats.items()}
+
+class ScheduledClient():
+    # Wraps a spotipy client so that each API call waits for its turn
+    def __init__(self, client, scheduler, priority):
+        self.client = client
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+        def scheduled(*args, **kwargs):
+            return self.scheduler.call(self.priority, attr, *args, **kwargs)
+        return scheduled
@@ -0,0 +1,109 @@
+import marshal
+import threading
+import time
+from collections import OrderedDict
+import codec
+import search_index
+
+# Remote search results, kept in memory in LRU order and written through to
+# the datastore so that they survive a restart. Entries expire after
+# TTL_SECONDS.
+#
+# A query that only extends a cached one ("beatl" -> "beatles") can reuse
+# the shorter query's results when Spotify returned fewer than a full page
+# of every kind for it: the longer query can't match anything new, so its
+# results are the shorter one's filtered down.
+
+FORMAT_VERSION = 1
+MAX_ENTRIES = 200
+TTL_SECONDS = 24 * 60 * 60
+KINDS = ('tracks', 'artists', 'albums')
+
+def normalize(query):
+    return " ".join(search_index.tokenize(query)) + (" " if query.endswith(" ") else "")
+
+def _name(item):
+    return getattr(item, 'title', None) or item.name
+
+def _matches(item, words, prefix):
+    item_words = search_index.tokenize(_name(item)) + search_index.tokenize(getattr(item, 'artist', None))
+    for i, word in enumerate(words):
+        if prefix and i == len(words) - 1:
+            if not any(item_word.startswith(word) for item_word in item_words):
+                return False
+        elif word not in item_words:
+            return False
+    return True
+
+class SearchCache():
+    def __init__(self, datastore, limit, max_entries = MAX_ENTRIES, ttl = TTL_SECONDS):
+        self.datastore = datastore
+        self.limit = limit
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = None
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    def _load(self):
+        # Oldest first, so the LRU order survives a restart
+        if self.entries is not None:
+            return
+        entries = []
+        for query, data in self.datastore.getSearchCache().items():
+            version, stored_at, encoded = marshal.loads(data)
+            if version == FORMAT_VERSION:
+                entries.append((stored_at, query, encoded))
+        entries.sort()
+        self.entries = OrderedDict((query, (stored_at, encoded)) for stored_at, query, encoded in entries)
+
+    def _fresh(self, query, now):
+        entry = self.entries.get(query)
+        if entry is None:
+            return None
+        if now - entry[0] > self.ttl:
+            del self.entries[query]
+            self.datastore.removeSearchCacheEntries([query])
+            return None
+        self.entries.move_to_end(query)
+        return dict(zip(KINDS, [codec.decode(items) for items in entry[1]]))
+
+    def get(self, query):
+        """Returns {kind: [entity]} for query from the cache, or None"""
+        query = normalize(query)
+        now = time.time()
+        with self.lock:
+            self._load()
+            found = self._fresh(query, now)
+            if found is not None:
+                self.hits = self.hits + 1
+                return found
+            words = query.split()
+            for length in range(len(query) - 1, 0, -1):
+                shorter = self._fresh(query[:length], now)
+                if shorter is None:
+                    continue
+                if any(len(shorter[kind]) >= self.limit for kind in KINDS):
+                    break
+                self.prefix_hits = self.prefix_hits + 1
+                prefix = not query.endswith(" ")
+                return {kind: [item for item in shorter[kind] if _matches(item, words, prefix)] for kind in KINDS}
+            self.misses = self.misses + 1
+            return None
+
+    def put(self, query, found):
+        query = normalize(query)
+        stored_at = time.time()
+        encoded = tuple(codec.encode(found[kind]) for kind in KINDS)
+        with self.lock:
+            self._load()
+            self.entries[query] = (stored_at, encoded)
+            self.entries.move_to_end(query)
+            evicted = []
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[0])
+        self.datastore.setSearchCacheEntry(query, marshal.dumps((FORMAT_VERSION, stored_at, encoded)))
+        if evicted:
+            self.datastore.removeSearchCacheEntries(evicted)
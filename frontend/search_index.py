@@ -0,0 +1,118 @@
+import bisect
+import heapq
+import marshal
+import re
+import unicodedata
+from array import array
+import codec
+
+# Offline search over the synced library. Every track, artist, album,
+# playlist and show name is split into normalized words; each word maps to
+# the documents it appears in. Words are kept sorted, so the last, still
+# being typed word of a query matches by prefix with a binary search.
+#
+# A posting is doc << 1, with the low bit set when the word comes from the
+# credit (a track's or album's artist, a show's publisher) rather than the
+# name, which ranks lower.
+
+FORMAT_VERSION = 1
+KINDS = ('tracks', 'artists', 'albums', 'playlists', 'shows')
+NAME_SCORE = 2.0
+CREDIT_SCORE = 1.0
+EXACT_BONUS = 0.5
+WORD = re.compile(r"\w+")
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return WORD.findall(text.lower())
+
+def _name(kind, item):
+    return item.title if kind == 'tracks' else item.name
+
+def _credit(item):
+    return getattr(item, 'artist', None) or getattr(item, 'publisher', None)
+
+class SearchIndex():
+    def __init__(self, items, terms, postings):
+        # items: {kind: [entity]}, terms: sorted words, postings: parallel
+        # to terms, packed arrays of postings
+        self.items = items
+        self.docs = [(kind, item) for kind in KINDS for item in items[kind]]
+        self.name_lengths = array('H', [min(0xFFFF, len(_name(kind, item))) for kind, item in self.docs])
+        self.terms = terms
+        self.postings = postings
+
+    @staticmethod
+    def build(tracks, artists, albums, playlists, shows):
+        items = {'tracks': tracks, 'artists': artists, 'albums': albums, 'playlists': playlists, 'shows': shows}
+        index = {}
+        doc = 0
+        for kind in KINDS:
+            for item in items[kind]:
+                name = set(tokenize(_name(kind, item)))
+                for word in name:
+                    index.setdefault(word, []).append(doc << 1)
+                for word in set(tokenize(_credit(item))) - name:
+                    index.setdefault(word, []).append(doc << 1 | 1)
+                doc = doc + 1
+        terms = tuple(sorted(index))
+        return SearchIndex(items, terms, tuple(array('I', index[term]).tobytes() for term in terms))
+
+    def encode(self):
+        return marshal.dumps((FORMAT_VERSION, tuple(codec.encode(self.items[kind]) for kind in KINDS),
+            self.terms, self.postings))
+
+    @staticmethod
+    def decode(data):
+        if data is None:
+            return None
+        version, encoded, terms, postings = marshal.loads(data)
+        if version != FORMAT_VERSION:
+            return None
+        return SearchIndex(dict(zip(KINDS, [codec.decode(items) for items in encoded])), terms, postings)
+
+    def _match(self, word, prefix):
+        # {doc: best score} for one query word
+        scores = {}
+        start = bisect.bisect_left(self.terms, word)
+        end = bisect.bisect_left(self.terms, word + "\uffff") if prefix else start + 1
+        for t in range(start, min(end, len(self.terms))):
+            term = self.terms[t]
+            if not prefix and term != word:
+                break
+            bonus = EXACT_BONUS if term == word else 0
+            postings = array('I')
+            postings.frombytes(self.postings[t])
+            for posting in postings:
+                score = (CREDIT_SCORE if posting & 1 else NAME_SCORE) + bonus
+                if score > scores.get(posting >> 1, 0):
+                    scores[posting >> 1] = score
+        return scores
+
+    def search(self, query, limit = 5):
+        """Returns {kind: [entity]} with up to limit best matches per kind.
+        Every word must match; the last one also matches as a prefix unless
+        the query ends with a space."""
+        results = {kind: [] for kind in KINDS}
+        words = tokenize(query)
+        scores = None
+        for i, word in enumerate(words):
+            matches = self._match(word, i == len(words) - 1 and not query.endswith(" "))
+            if scores is None:
+                scores = matches
+            else:
+                if len(matches) < len(scores):
+                    scores, matches = matches, scores
+                scores = {doc: score + matches[doc] for doc, score in scores.items() if doc in matches}
+            if not scores:
+                break
+        if not scores:
+            return results
+        by_kind = {kind: [] for kind in KINDS}
+        for doc in scores:
+            by_kind[self.docs[doc][0]].append(doc)
+        rank = lambda doc: (-scores[doc], self.name_lengths[doc], doc)
+        for kind, docs in by_kind.items():
+            results[kind] = [self.docs[doc][1] for doc in heapq.nsmallest(limit, docs, key=rank)]
+        return results
@@ -1,88 +1,29 @@
-import spotipy
 import datastore
 from spotipy.oauth2 import SpotifyOAuth
 import threading
 import time
 import json
-
-class UserDevice():
-    __slots__ = ['id', 'name', 'is_active']
-    def __init__(self, id, name, is_active):
-        self.id = id
-        self.name = name
-        self.is_active = is_active
-
-class UserTrack():
-    __slots__ = ['title', 'artist', 'album', 'uri']
-    def __init__(self, title, artist, album, uri):
-        self.title = title
-        self.artist = artist
-        self.album = album
-        self.uri = uri
-
-    def __str__(self):
-        return self.title + " - " + self.artist + " - " + self.album
-
-class UserAlbum():
-    __slots__ = ['name', 'artist', 'track_count', 'uri']
-    def __init__(self, name, artist, track_count, uri):
-        self.name = name
-        self.artist = artist
-        self.uri = uri
-        self.track_count = track_count
-
-    def __str__(self):
-        return self.name + " - " + self.artist
-
-class UserEpisode():
-    __slots__ = ['name', 'publisher', 'show', 'uri']
-    def __init__(self, name, publisher, show, uri):
-        self.name = name
-        self.publisher = publisher
-        self.show = show
-        self.uri = uri
-
-    def __str__(self):
-        return self.name + " - " + self.publisher
-
-class UserShow():
-    __slots__ = ['name', 'publisher', 'episode_count', 'uri']
-    def __init__(self, name, publisher, episode_count, uri):
-        self.name = name
-        self.publisher = publisher
-        self.episode_count = episode_count
-        self.uri = uri
-
-    def __str__(self):
-        return self.name + " - " + self.publisher
-
-class UserArtist():
-    __slots__ = ['name', 'uri']
-    def __init__(self, name, uri):
-        self.name = name
-        self.uri = uri
-
-    def __str__(self):
-        return self.name
-
-class UserPlaylist(): 
-    __slots__ = ['name', 'idx', 'uri', 'track_count']
-    def __init__(self, name, idx, uri, track_count):
-        self.name = name
-        self.idx = idx
-        self.uri = uri
-        self.track_count = track_count
-
-    def __str__(self):
-        return self.name
+import fetch_pool
+import search_index
+import search_cache
+import paged_collection
+import transport
+import scheduler
+import command_queue
+import poller
+from models import UserDevice, UserTrack, UserAlbum, UserEpisode, UserShow, UserArtist, UserPlaylist
 
 class SearchResults():
-    __slots__ = ['tracks', 'artists', 'albums', 'album_track_map']
-    def __init__(self, tracks, artists, albums, album_track_map):
+    __slots__ = ['tracks', 'artists', 'albums', 'album_track_map', 'playlists', 'shows']
+    def __init__(self, tracks, artists, albums, album_track_map, playlists = [], shows = []):
         self.tracks = tracks
         self.artists = artists
         self.albums = albums
+        # Tracks of the albums that aren't in the library by album uri, None
+        # until the album is opened
         self.album_track_map = album_track_map
+        self.playlists = playlists
+        self.shows = shows
 
 scope = "user-follow-read," \
         "user-library-read," \
@@ -99,10 +40,41 @@ scope = "user-follow-read," \
 
 DATASTORE = datastore.Datastore()
 
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope))
+auth_manager = SpotifyOAuth(scope=scope, requests_session=transport.session(2))
+SCHEDULER = scheduler.RequestScheduler()
+interactive_client = transport.client(auth_manager, transport.INTERACTIVE_TIMEOUT, pool_size=4)
+# Playback commands and search
+sp = scheduler.ScheduledClient(interactive_client, SCHEDULER, scheduler.INTERACTIVE)
+# The now-playing poller and device refreshes
+poll_sp = scheduler.ScheduledClient(interactive_client, SCHEDULER, scheduler.POLL)
+# Client for the concurrent sync fetches: 429s are not retried by the session
+# so that FETCH_POOL can apply the Retry-After to every request at once
+FETCH_POOL = fetch_pool.FetchPool(gate=SCHEDULER.gate)
+sync_sp = scheduler.ScheduledClient(
+    transport.client(auth_manager, transport.BULK_TIMEOUT, pool_size=2 * FETCH_POOL.workers, retry_rate_limits=False),
+    SCHEDULER, scheduler.BULK)
+transport.TokenRefresher(auth_manager).start()
 
 
 pageSize = 50
+# Spotify's previous restarts the current track once it has played this long
+PREVIOUS_RESTARTS_MS = 3000
+# How long a poll may disagree with a prediction before it counts as wrong
+PREDICTION_GRACE_SECONDS = 3
+SEARCH_LIMIT = 5
+PREDICTION_STATS = {'predicted': 0, 'reconciled': 0, 'mispredictions': 0}
+prediction = None
+local_index = None
+prediction_lock = threading.RLock()
+SEARCH_CACHE = search_cache.SearchCache(DATASTORE, SEARCH_LIMIT)
+# Only what parse_track keeps, for the endpoints that accept a fields filter
+TRACK_FIELDS = "name,uri,artists(name),album(name)"
+PLAYLIST_TRACKS_FIELDS = "items(track(" + TRACK_FIELDS + ")),offset,limit,total,next"
+PLAYLIST_FIELDS = "name,uri,tracks.items(track(" + TRACK_FIELDS + "))"
+# Endpoints without a fields filter still drop their available_markets
+# arrays, usually the bulk of a track, when given a market
+MARKET = "from_token"
+ALBUM_BATCH_SIZE = 20
 has_internet = False
 
 def check_internet(request):
@@ -116,27 +88,23 @@ def check_internet(request):
         has_internet = False
     return result
 
-def get_playlist(id):
-    # TODO optimize query
-    results = sp.playlist(id)
-    tracks = []
-    for _, item in enumerate(results['tracks']['items']):
-        track = item['track']
-        tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
+def get_playlist(id, client = sp):
+    results = client.playlist(id, fields=PLAYLIST_FIELDS, market=MARKET)
+    tracks = [parse_track(item['track']) for item in results['tracks']['items']]
     return (UserPlaylist(results['name'], 0, results['uri'], len(tracks)), tracks) # return playlist index as 0 because it won't have a idx parameter when fetching directly from Spotify (and we don't need it here anyway)
 
-def get_show(id):
-    results = sp.show(id)
+def get_show(id, client = sp):
+    results = client.show(id, market=MARKET)
     show = results['name']
     publisher = results['publisher']
     episodes = []
     for _, item in enumerate(results['episodes']['items']):
         episodes.append(UserEpisode(item['name'], publisher, show, item['uri']))
-    return (UserShow(results['name'], publisher, len(episodes), results['uri']), episodes)
+    # Only the first page of episodes, see load_more_episodes
+    return (UserShow(results['name'], publisher, results['episodes'].get('total', len(episodes)), results['uri']), episodes)
 
-def get_album(id):
-    # TODO optimize query
-    results = sp.album(id)
+def get_album(id, client = sp):
+    results = client.album(id, market=MARKET)
     album = results['name']
     artist = results['artists'][0]['name']
     tracks = []
@@ -144,138 +112,316 @@ def get_album(id):
         tracks.append(UserTrack(item['name'], artist, album, item['uri']))
     return (UserAlbum(results['name'], artist, len(tracks), results['uri']), tracks)
 
+def paginate_pages(fetch, key = None, cursor = False, client = sp):
+    """Yields (offset, items) for every page of a Spotify collection.
+    fetch(offset) returns the page at offset; pages after the first are
+    fetched in parallel on FETCH_POOL once its total is known. key unwraps
+    responses nested one level down, e.g. 'artists'. Cursor-based
+    collections can't be fetched out of order and are followed serially."""
+    return FETCH_POOL.pages(fetch, key, client.next if cursor else None)
+
+def paginate(fetch, key = None, cursor = False, client = sp):
+    """Yields every item of a Spotify collection in order, see paginate_pages"""
+    for _, items in paginate_pages(fetch, key, cursor, client):
+        for item in items:
+            yield item
+
+def parse_track(track):
+    return UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri'])
+
 def get_playlist_tracks(id):
-    tracks = []
-    results = sp.playlist_tracks(id, limit=pageSize)
-    while(results['next']):
-        for _, item in enumerate(results['items']):
-            track = item['track']
-            tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-        results = sp.next(results)
-    for _, item in enumerate(results['items']):
-        track = item['track']
-        tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-    return tracks
+    items = paginate(lambda offset: sync_sp.playlist_tracks(id, fields=PLAYLIST_TRACKS_FIELDS, limit=pageSize, offset=offset, market=MARKET), client=sync_sp)
+    return [parse_track(item['track']) for item in items]
 
 def get_album_tracks(id):
-    tracks = []
-    results = sp.playlist_tracks(id, limit=pageSize)
-    while(results['next']):
-        for _, item in enumerate(results['items']):
-            track = item['track']
-            tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-        results = sp.next(results)
-    for _, item in enumerate(results['items']):
-        track = item['track']
-        tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-    return tracks
+    items = paginate(lambda offset: sp.playlist_tracks(id, fields=PLAYLIST_TRACKS_FIELDS, limit=pageSize, offset=offset, market=MARKET))
+    return [parse_track(item['track']) for item in items]
+
+def startup_sync():
+    # Network work that must not delay the first frame
+    check_internet(refresh_devices)
+    print("Refreshed devices")
+
+def run_startup_sync():
+    thread = threading.Thread(target=startup_sync, args=())
+    thread.daemon = True
+    thread.start()
 
 def refresh_devices():
-    results = sp.devices()
+    results = poll_sp.devices()
     DATASTORE.clearDevices()
-    for _, item in enumerate(results['devices']):
-        if "Spotifypod" in item['name']:
-            print(item['name'])
-            device = UserDevice(item['id'], item['name'], item['is_active'])
-            DATASTORE.setUserDevice(device)
-
-def parse_album(album):
+    with DATASTORE.batch():
+        for _, item in enumerate(results['devices']):
+            if "Spotifypod" in item['name']:
+                print(item['name'])
+                device = UserDevice(item['id'], item['name'], item['is_active'])
+                DATASTORE.setUserDevice(device)
+
+def parse_album(album, client = sync_sp):
     artist = album['artists'][0]['name']
     tracks = []
     if 'tracks' not in album :
-        return get_album(album['id'])
+        return get_album(album['id'], client)
     for _, track in enumerate(album['tracks']['items']):
         tracks.append(UserTrack(track['name'], artist, album['name'], track['uri']))
     return (UserAlbum(album['name'], artist, len(tracks), album['uri']), tracks)
 
-def parse_show(show):
+def parse_albums(albums, client = sync_sp):
+    """parse_album for a list of albums. The ones without tracks (new
+    releases) are fetched ALBUM_BATCH_SIZE at a time from
+    the several-albums endpoint instead of one request each."""
+    missing = [album['id'] for album in albums if 'tracks' not in album]
+    batches = [missing[i:i + ALBUM_BATCH_SIZE] for i in range(0, len(missing), ALBUM_BATCH_SIZE)]
+    full = {}
+    for results in FETCH_POOL.imap(lambda ids: client.albums(ids, market=MARKET), batches):
+        for album in results['albums']:
+            if album:
+                full[album['id']] = album
+    return [parse_album(full.get(album['id'], album), client) for album in albums]
+
+def parse_show(show, client = sync_sp):
+    # Runs on FETCH_POOL, so it fetches with sync_sp, whose 429s reach the pool
     publisher = show['publisher']
     episodes = []
     if 'episodes' not in show :
-        return get_show(show['id'])
+        return get_show(show['id'], client)
     for _, episode in enumerate(show['episodes']['items']):
         episodes.append(UserEpisode(episode['name'], publisher, show['name'], episode['uri']))
-    return (UserShow(show['name'], publisher, len(episodes), show['uri']), episodes)
+    return (UserShow(show['name'], publisher, show['episodes'].get('total', len(episodes)), show['uri']), episodes)
     
 def refresh_data():
-    DATASTORE.clear()
-    results = sp.current_user_saved_tracks(limit=pageSize, offset=0)
-    while(results['next']):
-        offset = results['offset']
-        for idx, item in enumerate(results['items']):
-            track = item['track']
-            DATASTORE.setSavedTrack(idx + offset, UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-        results = sp.next(results)
-
-    offset = results['offset']
-    for idx, item in enumerate(results['items']):
-        track = item['track']
-        DATASTORE.setSavedTrack(idx + offset, UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-
-    print("Spotify tracks fetched")
-
-    offset = 0
-    results = sp.current_user_followed_artists(limit=pageSize)
-    while(results['artists']['next']):
-        for idx, item in enumerate(results['artists']['items']):
-            DATASTORE.setArtist(idx + offset, UserArtist(item['name'], item['uri']))
-        results = sp.next(results['artists'])
-        offset = offset + pageSize
-
-    for idx, item in enumerate(results['artists']['items']):
-        DATASTORE.setArtist(idx + offset, UserArtist(item['name'], item['uri']))
-
-    print("Spotify artists fetched: " + str(DATASTORE.getArtistCount()))
-
-    results = sp.current_user_playlists(limit=pageSize)
-    totalindex = 0 # variable to preserve playlist sort index when calling offset loop down below
-    while(results['next']):
-        offset = results['offset']
-        for idx, item in enumerate(results['items']):
-            tracks = get_playlist_tracks(item['id'])
-            DATASTORE.setPlaylist(UserPlaylist(item['name'], totalindex, item['uri'], len(tracks)), tracks, index=idx + offset)
-            totalindex = totalindex + 1
-        results = sp.next(results)
-
-    offset = results['offset']
-    for idx, item in enumerate(results['items']):
-        tracks = get_playlist_tracks(item['id'])
-        DATASTORE.setPlaylist(UserPlaylist(item['name'], totalindex, item['uri'], len(tracks)), tracks, index=idx + offset)
-        totalindex = totalindex + 1
-
-    print("Spotify playlists fetched: " + str(DATASTORE.getPlaylistCount()))
-
-    results = sp.current_user_saved_albums(limit=pageSize)
-    while(results['next']):
-        offset = results['offset']
-        for idx, item in enumerate(results['items']):
-            album, tracks = parse_album(item['album'])
-            DATASTORE.setAlbum(album, tracks, index=idx + offset)
-        results = sp.next(results)
-
-    offset = results['offset']
-    for idx, item in enumerate(results['items']):
-        album, tracks = parse_album(item['album'])
-        DATASTORE.setAlbum(album, tracks, index=idx + offset)
-
-    print("Refreshed user albums")
-
-    results = sp.new_releases(limit=pageSize)
-    for idx, item in enumerate(results['albums']['items']):
-        album, tracks = parse_album(item)
-        DATASTORE.setNewRelease(album, tracks, index=idx)
-
-    print("Refreshed new releases")
-
-    results = sp.current_user_saved_shows(limit=pageSize)
-    if(len(results['items']) > 0):
-        offset = results['offset']
-        for idx, item in enumerate(results['items']):
-            show, episodes = parse_show(item['show'])
-            DATASTORE.setShow(show, episodes, index=idx)
-
-    print("Spotify Shows fetched")
+    with DATASTORE.refresh():
+        # Only the first page, the rest is fetched as it is browsed
+        store_saved_tracks(0, *fetch_saved_tracks(0, pageSize, True))
+
+        print("Spotify tracks fetched")
+
+        for offset, items in paginate_pages(lambda _: sync_sp.current_user_followed_artists(limit=pageSize),
+                key='artists', cursor=True, client=sync_sp):
+            with DATASTORE.batch():
+                for idx, item in enumerate(items):
+                    DATASTORE.setArtist(idx + offset, UserArtist(item['name'], item['uri']))
 
+        print("Spotify artists fetched: " + str(DATASTORE.getArtistCount()))
+
+        for offset, items in paginate_pages(lambda offset: sync_sp.current_user_playlists(limit=pageSize, offset=offset), client=sync_sp):
+            track_lists = FETCH_POOL.map(get_playlist_tracks, [item['id'] for item in items])
+            with DATASTORE.batch():
+                for idx, item in enumerate(items):
+                    tracks = track_lists[idx]
+                    DATASTORE.setPlaylist(UserPlaylist(item['name'], idx + offset, item['uri'], len(tracks)), tracks, index=idx + offset, snapshot_id=item['snapshot_id'])
+
+        print("Spotify playlists fetched: " + str(DATASTORE.getPlaylistCount()))
+
+        for offset, items in paginate_pages(lambda offset: sync_sp.current_user_saved_albums(limit=pageSize, offset=offset, market=MARKET), client=sync_sp):
+            albums = parse_albums([item['album'] for item in items])
+            with DATASTORE.batch():
+                for idx, (album, tracks) in enumerate(albums):
+                    DATASTORE.setAlbum(album, tracks, index=idx + offset)
+
+        print("Refreshed user albums")
+
+        # New releases and shows: only the first page, the rest is fetched
+        # as it is browsed
+        results = FETCH_POOL.call(lambda: sync_sp.new_releases(limit=pageSize))
+        albums = parse_albums(results['albums']['items'])
+        with DATASTORE.batch():
+            for idx, (album, tracks) in enumerate(albums):
+                DATASTORE.setNewRelease(album, tracks, index=idx)
+            DATASTORE.setCollectionTotal("nr", results['albums']['total'])
+
+        print("Refreshed new releases")
+
+        results = FETCH_POOL.call(lambda: sync_sp.current_user_saved_shows(limit=pageSize, market=MARKET))
+        shows = FETCH_POOL.map(parse_show, [item['show'] for item in results['items']])
+        with DATASTORE.batch():
+            for idx, (show, episodes) in enumerate(shows):
+                DATASTORE.setShow(show, episodes, index=idx)
+            DATASTORE.setCollectionTotal("show", results['total'])
+
+        print("Spotify Shows fetched")
+
+        build_search_index()
+
+    SAVED_TRACKS.reset()
+    refresh_devices()
+    print("Refreshed devices")
+
+def walk_saved_items(fetch, item_id, known_ids, client = sync_sp):
+    # Walks a newest-first saved collection until it reaches the newest item
+    # already stored. Returns (new items, complete), where complete means the
+    # whole collection was walked and replaces the stored one.
+    def walk(newest_id):
+        new_items = []
+        results = FETCH_POOL.call(fetch)
+        while True:
+            for item in results['items']:
+                if item_id(item) == newest_id:
+                    return (new_items, results['total'], False)
+                new_items.append(item)
+            if not results['next']:
+                return (new_items, results['total'], True)
+            results = FETCH_POOL.call(client.next, results)
+    new_items, total, complete = walk(known_ids[0] if known_ids else None)
+    if not complete and len(new_items) + len(known_ids) != total:
+        # Items were removed somewhere below the new ones
+        new_items, _, complete = walk(None)
+    return (new_items, complete)
+
+def fetch_saved_tracks(start, count, background):
+    if background:
+        results = FETCH_POOL.call(lambda: sync_sp.current_user_saved_tracks(limit=count, offset=start, market=MARKET))
+    else:
+        results = sp.current_user_saved_tracks(limit=count, offset=start, market=MARKET)
+    return ([parse_track(item['track']) for item in results['items']], results['total'])
+
+def store_saved_tracks(start, tracks, total):
+    with DATASTORE.batch():
+        DATASTORE.setSavedTracks(start, tracks, total)
+
+SAVED_TRACKS = paged_collection.PagedCollection(DATASTORE.getSavedTracks, fetch_saved_tracks, store_saved_tracks, page_size=pageSize)
+
+def sync_saved_tracks():
+    # Only the first page is kept up to date. If it changed, the stored
+    # pages after it may have shifted and are dropped, to be fetched again
+    # when browsed.
+    tracks, total = fetch_saved_tracks(0, pageSize, True)
+    if total == DATASTORE.getSavedTrackCount() and \
+            [track.uri for track in tracks] == DATASTORE.getSavedTrackUris(0, len(tracks)):
+        return
+    with DATASTORE.batch():
+        DATASTORE.clearSavedTracks()
+        DATASTORE.setSavedTracks(0, tracks, total)
+    SAVED_TRACKS.reset()
+    print("Saved tracks synced: " + str(total) + " in total")
+
+def sync_saved_albums():
+    known_ids = DATASTORE.getIndexedIds("album")
+    items, complete = walk_saved_items(lambda: sync_sp.current_user_saved_albums(limit=pageSize, market=MARKET),
+        lambda item: item['album']['id'], known_ids)
+    if len(items) == 0 and not complete:
+        return
+    ids = [item['album']['id'] for item in items]
+    new_albums = [item['album'] for item in items if not (complete and item['album']['id'] in known_ids)]
+    albums = parse_albums(new_albums)
+    with DATASTORE.batch():
+        for album, tracks in albums:
+            DATASTORE.setAlbum(album, tracks)
+        if complete:
+            for album_id in set(known_ids) - set(ids):
+                DATASTORE.removeItem("album", album_id)
+        DATASTORE.setIndexedIds("album", ids + ([] if complete else known_ids))
+    print("Saved albums synced: " + str(len(items)) + " walked")
+
+def sync_playlists():
+    snapshots = DATASTORE.getPlaylistSnapshots()
+    known_ids = DATASTORE.getIndexedIds("playlist")
+    ids = []
+    fetched = 0
+    for _, items in paginate_pages(lambda offset: sync_sp.current_user_playlists(limit=pageSize, offset=offset), client=sync_sp):
+        changed = [item['id'] for item in items if snapshots.get(item['id']) != item['snapshot_id']]
+        track_lists = dict(zip(changed, FETCH_POOL.map(get_playlist_tracks, changed)))
+        with DATASTORE.batch():
+            for item in items:
+                playlist_id = item['id']
+                if playlist_id not in track_lists:
+                    # Unchanged, but its position in the library may have moved
+                    playlist = UserPlaylist(item['name'], len(ids), item['uri'], item['tracks']['total'])
+                    DATASTORE.setPlaylist(playlist, None)
+                else:
+                    tracks = track_lists[playlist_id]
+                    playlist = UserPlaylist(item['name'], len(ids), item['uri'], len(tracks))
+                    DATASTORE.setPlaylist(playlist, tracks, snapshot_id=item['snapshot_id'])
+                    fetched = fetched + 1
+                ids.append(playlist_id)
+    with DATASTORE.batch():
+        for playlist_id in set(known_ids) - set(ids):
+            DATASTORE.removeItem("playlist", playlist_id)
+        DATASTORE.setIndexedIds("playlist", ids)
+    print("Playlists synced: " + str(fetched) + " changed")
+
+def sync_artists():
+    items = paginate(lambda _: sync_sp.current_user_followed_artists(limit=pageSize), key='artists', cursor=True, client=sync_sp)
+    artists = [UserArtist(item['name'], item['uri']) for item in items]
+    with DATASTORE.batch():
+        DATASTORE.clearArtists()
+        for idx, artist in enumerate(artists):
+            DATASTORE.setArtist(idx, artist)
+
+def sync_new_releases():
+    known_ids = DATASTORE.getIndexedIds("nr")
+    results = FETCH_POOL.call(lambda: sync_sp.new_releases(limit=pageSize))
+    ids = [item['id'] for item in results['albums']['items']]
+    albums = parse_albums([item for item in results['albums']['items'] if item['id'] not in known_ids])
+    with DATASTORE.batch():
+        for album, tracks in albums:
+            DATASTORE.setNewRelease(album, tracks)
+        for album_id in set(known_ids) - set(ids):
+            DATASTORE.removeItem("nr", album_id)
+        DATASTORE.setIndexedIds("nr", ids)
+        DATASTORE.setCollectionTotal("nr", results['albums']['total'])
+
+def sync_shows():
+    known_ids = DATASTORE.getIndexedIds("show")
+    results = FETCH_POOL.call(lambda: sync_sp.current_user_saved_shows(limit=pageSize, market=MARKET))
+    ids = [item['show']['id'] for item in results['items']]
+    shows = FETCH_POOL.map(parse_show, [item['show'] for item in results['items'] if item['show']['id'] not in known_ids])
+    with DATASTORE.batch():
+        for show, episodes in shows:
+            DATASTORE.setShow(show, episodes)
+        for show_id in set(known_ids) - set(ids):
+            DATASTORE.removeItem("show", show_id)
+        DATASTORE.setIndexedIds("show", ids)
+        DATASTORE.setCollectionTotal("show", results['total'])
+
+def load_more_new_releases():
+    """Stores the next page of new releases after the ones stored. Returns
+    how many were added."""
+    offset = DATASTORE.getNewReleasesCount()
+    results = sp.new_releases(limit=pageSize, offset=offset)
+    albums = parse_albums(results['albums']['items'])
+    with DATASTORE.batch():
+        for idx, (album, tracks) in enumerate(albums):
+            DATASTORE.setNewRelease(album, tracks, index=offset + idx)
+        DATASTORE.setCollectionTotal("nr", results['albums']['total'])
+    return len(albums)
+
+def load_more_shows():
+    """Stores the next page of saved shows, see load_more_new_releases"""
+    offset = DATASTORE.getShowsCount()
+    results = sp.current_user_saved_shows(limit=pageSize, offset=offset, market=MARKET)
+    shows = FETCH_POOL.map(parse_show, [item['show'] for item in results['items']])
+    with DATASTORE.batch():
+        for idx, (show, episodes) in enumerate(shows):
+            DATASTORE.setShow(show, episodes, index=offset + idx)
+        DATASTORE.setCollectionTotal("show", results['total'])
+    return len(shows)
+
+def load_more_episodes(show):
+    """Stores the next page of a show's episodes, see load_more_new_releases"""
+    episodes = DATASTORE.getShowEpisodes(show.uri) or []
+    results = sp.show_episodes(show.uri, limit=pageSize, offset=len(episodes), market=MARKET)
+    more = [UserEpisode(item['name'], show.publisher, show.name, item['uri']) for item in results['items'] if item]
+    with DATASTORE.batch():
+        DATASTORE.setShowEpisodes(show.uri, episodes + more)
+    return len(more)
+
+def delta_sync_data():
+    """Brings the stored library up to date in place, refetching only what
+    changed: playlists whose snapshot_id moved and saved tracks and albums
+    added since the newest stored one. Falls back to a full refresh_data()
+    when nothing has been synced yet."""
+    if DATASTORE.getPlaylistCount() == 0 and DATASTORE.getSavedTrackCount() == 0:
+        return refresh_data()
+    sync_saved_tracks()
+    sync_artists()
+    sync_playlists()
+    sync_saved_albums()
+    sync_new_releases()
+    sync_shows()
+    build_search_index()
+    print("Library synced")
+    DATASTORE.writeSnapshot()
     refresh_devices()
     print("Refreshed devices")
 
@@ -331,7 +477,7 @@ def play_from_show(show_uri, episode_uri, device_id = None):
     refresh_now_playing()
 
 def get_now_playing():
-    response = check_internet(lambda: sp.current_playback(additional_types='episode'))
+    response = check_internet(lambda: poll_sp.current_playback(additional_types='episode'))
     if (not response):
         return None
 
@@ -340,6 +486,12 @@ def get_now_playing():
     else:
         return get_now_playing_track(response = response)
 
+def set_track_position(now_playing, context_uri, track_uri):
+    position, total = DATASTORE.getTrackPosition(context_uri, track_uri)
+    if position is not None:
+        now_playing['track_index'] = position + 1
+    now_playing['track_total'] = total
+
 def get_now_playing_track(response = None):
     if(not response or not response['item']):
         return None
@@ -357,6 +509,8 @@ def get_now_playing_track(response = None):
         'is_playing': response['is_playing'],
         'progress': response['progress_ms'],
         'context_name': artist,
+        'context_uri': context['uri'] if context else None,
+        'shuffle': response['shuffle_state'],
         'track_index': -1,
         'timestamp': time.time()
     }
@@ -365,24 +519,18 @@ def get_now_playing_track(response = None):
     if (context['type'] == 'playlist'):
         uri = context['uri']
         playlist = DATASTORE.getPlaylistUri(uri)
-        tracks = DATASTORE.getPlaylistTracks(uri)
         if (not playlist):
-            playlist, tracks = get_playlist(uri.split(":")[-1])
+            playlist, tracks = get_playlist(uri.split(":")[-1], client=poll_sp)
             DATASTORE.setPlaylist(playlist, tracks)
-        now_playing['track_index'] = next(x for x, val in enumerate(tracks) 
-                                  if val.uri == track_uri) + 1
-        now_playing['track_total'] = len(tracks)
+        set_track_position(now_playing, uri, track_uri)
         now_playing['context_name'] = playlist.name
     elif (context['type'] == 'album'):
         uri = context['uri']
         album = DATASTORE.getAlbumUri(uri)
-        tracks = DATASTORE.getPlaylistTracks(uri)
         if (not album):
-            album, tracks = get_album(uri.split(":")[-1])
+            album, tracks = get_album(uri.split(":")[-1], client=poll_sp)
             DATASTORE.setAlbum(album, tracks)
-        now_playing['track_index'] = next(x for x, val in enumerate(tracks) 
-                                  if val.uri == track_uri) + 1
-        now_playing['track_total'] = len(tracks)
+        set_track_position(now_playing, uri, track_uri)
         now_playing['context_name'] = album.name
     return now_playing
 
@@ -408,71 +556,206 @@ def get_now_playing_episode(response = None):
     
     return now_playing
 
+def build_search_index():
+    global local_index
+    albums = {album.uri: album for album in DATASTORE.getAllSavedAlbums() + DATASTORE.getAllNewReleases()}
+    playlists = DATASTORE.getAllSavedPlaylists()
+    playlists.sort(key=lambda playlist: playlist.idx)
+    index = search_index.SearchIndex.build(DATASTORE.getAllTracks(), DATASTORE.getAllArtists(),
+        list(albums.values()), playlists, DATASTORE.getAllSavedShows())
+    DATASTORE.setSearchIndex(index.encode())
+    local_index = None
+    print("Search index built: " + str(len(index.terms)) + " words")
+
+def get_search_index():
+    global local_index
+    generation = DATASTORE.generation
+    if local_index is None or local_index[0] != generation:
+        local_index = (generation, search_index.SearchIndex.decode(DATASTORE.getSearchIndex()))
+    return local_index[1]
+
+def local_search(query):
+    index = get_search_index()
+    if index is None:
+        return SearchResults([], [], [], {})
+    found = index.search(query, SEARCH_LIMIT)
+    return SearchResults(found['tracks'], found['artists'], found['albums'], {}, found['playlists'], found['shows'])
+
+def remote_search(query):
+    """{kind: [entity]} for tracks, artists and albums from one Spotify
+    search request, or from SEARCH_CACHE when the query, or a shorter one
+    it refines, was searched recently. Albums come without their tracks,
+    see search_album_tracks. None if Spotify can't be reached."""
+    found = SEARCH_CACHE.get(query)
+    if found is not None:
+        return found
+    found = check_internet(lambda: parse_search(sp.search(query, limit=SEARCH_LIMIT, type='track,artist,album', market=MARKET)))
+    if found is not None:
+        SEARCH_CACHE.put(query, found)
+    return found
+
+def parse_search(results):
+    return {
+        'tracks': [parse_track(item) for item in results['tracks']['items'] if item],
+        'artists': [UserArtist(item['name'], item['uri']) for item in results['artists']['items'] if item],
+        'albums': [UserAlbum(item['name'], item['artists'][0]['name'], item['total_tracks'], item['uri'])
+            for item in results['albums']['items'] if item],
+    }
+
+def merge_items(local, remote):
+    uris = set(item.uri for item in local)
+    return local + [item for item in remote if item.uri not in uris]
+
 def search(query):
-    track_results = sp.search(query, limit=5, type='track')
-    tracks = []
-    for _, item in enumerate(track_results['tracks']['items']):
-        tracks.append(UserTrack(item['name'], item['artists'][0]['name'], item['album']['name'], item['uri']))
-    artist_results = sp.search(query, limit=5, type='artist')
-    artists = []
-    for _, item in enumerate(artist_results['artists']['items']):
-        artists.append(UserArtist(item['name'], item['uri']))
-    album_results = sp.search(query, limit=5, type='album')
-    albums = []
-    album_track_map = {}
-    for _, item in enumerate(album_results['albums']['items']):
-        album, album_tracks = parse_album(item)
-        albums.append(album)
-        album_track_map[album.uri] = album_tracks
-    return SearchResults(tracks, artists, albums, album_track_map)
+    """Library matches first, from the local index, then whatever else
+    Spotify finds when it can be reached. Spotify is asked even while
+    offline, so that a failed search doesn't turn remote results off
+    until the next poll."""
+    results = local_search(query)
+    remote = remote_search(query)
+    if remote is None:
+        return results
+    local_albums = set(album.uri for album in results.albums)
+    return SearchResults(merge_items(results.tracks, remote['tracks']), merge_items(results.artists, remote['artists']),
+        merge_items(results.albums, remote['albums']),
+        {album.uri: None for album in remote['albums'] if album.uri not in local_albums},
+        results.playlists, results.shows)
+
+def search_album_tracks(results, album):
+    """Tracks of an album found by search outside the library, fetched the
+    first time it is opened. None if they can't be fetched."""
+    tracks = results.album_track_map.get(album.uri)
+    if tracks is None:
+        found = check_internet(lambda: get_album(album.uri))
+        if found is None:
+            return None
+        tracks = found[1]
+        results.album_track_map[album.uri] = tracks
+    return tracks
 
 def refresh_now_playing():
-    DATASTORE.now_playing = get_now_playing()
-
-def play_next():
-    global sleep_time
-    sp.next_track()
-    sleep_time = 0.4
-    refresh_now_playing()
+    global prediction
+    started = time.time()
+    now_playing = get_now_playing()
+    with prediction_lock:
+        if prediction is not None:
+            if not COMMANDS.is_settled(started):
+                # Polled before the commands reached Spotify
+                return
+            if not prediction_matches(now_playing):
+                if time.time() - COMMANDS.last_done < PREDICTION_GRACE_SECONDS:
+                    # Spotify may not have caught up with the command yet
+                    return
+                PREDICTION_STATS['mispredictions'] = PREDICTION_STATS['mispredictions'] + 1
+                print("mispredicted now playing, " + str(PREDICTION_STATS))
+            PREDICTION_STATS['reconciled'] = PREDICTION_STATS['reconciled'] + 1
+            prediction = None
+        DATASTORE.now_playing = now_playing
+
+def prediction_matches(now_playing):
+    if not now_playing or now_playing['is_playing'] != prediction['is_playing']:
+        return False
+    if prediction['track_uri'] is None:
+        # Skipped to a track that wasn't known in advance
+        return now_playing['track_uri'] != prediction['from_uri']
+    return now_playing['track_uri'] == prediction['track_uri']
+
+def predict(expected_uri, **changes):
+    """Shows the expected result of a command right away. expected_uri is
+    the track expected to be playing once it's done, None if not known."""
+    global prediction
+    now_playing = DATASTORE.now_playing
+    from_uri = prediction['from_uri'] if prediction else now_playing['track_uri']
+    DATASTORE.now_playing = dict(now_playing, **changes)
+    prediction = {'from_uri': from_uri, 'track_uri': expected_uri, 'is_playing': DATASTORE.now_playing['is_playing']}
+    PREDICTION_STATS['predicted'] = PREDICTION_STATS['predicted'] + 1
+
+def current_progress(now_playing):
+    elapsed = (time.time() - now_playing['timestamp']) * 1000.0 if now_playing['is_playing'] else 0
+    return now_playing['progress'] + elapsed
+
+def skip_target(now_playing, count):
+    """Position in the playing context count skips away, None when unknown"""
+    index = now_playing['track_index'] if now_playing else -1
+    if index <= 0 or not now_playing['context_uri'] or now_playing['shuffle']:
+        return None
+    if count < 0 and current_progress(now_playing) > PREVIOUS_RESTARTS_MS:
+        # The first previous only restarts the current track
+        count = count + 1
+    return min(max(0, index - 1 + count), now_playing['track_total'] - 1)
+
+def skip_tracks(count, now_playing = None):
+    """Skips count tracks forward, or back if negative, from now_playing.
+    Where the position in the playing context is known this is a single
+    request."""
+    position = skip_target(now_playing, count) if abs(count) > 1 else None
+    if position is not None:
+        sp.start_playback(context_uri=now_playing['context_uri'], offset={"position": position})
+    else:
+        for _ in range(abs(count)):
+            if count > 0:
+                sp.next_track()
+            else:
+                sp.previous_track()
 
-def play_previous():
-    global sleep_time
-    sp.previous_track()
-    sleep_time = 0.4
-    refresh_now_playing()
+def queue_skip(count):
+    now_playing = DATASTORE.now_playing
+    # Behind a queued play the shown context is about to be replaced
+    stale = COMMANDS.has_run_ahead()
+    if count > 0:
+        COMMANDS.next(now_playing)
+    else:
+        COMMANDS.previous(now_playing)
+    if not now_playing:
+        return
+    with prediction_lock:
+        changes = {'progress': 0, 'timestamp': time.time()}
+        position = None if stale else skip_target(now_playing, count)
+        if position is None:
+            track_uri = None
+        elif position + 1 == now_playing['track_index']:
+            track_uri = now_playing['track_uri']
+        else:
+            changes['track_index'] = position + 1
+            tracks, _ = DATASTORE.getPlaylistTrackRange(now_playing['context_uri'], position, 1)
+            track_uri = tracks[0].uri if tracks else None
+            if tracks:
+                changes.update(name=tracks[0].title, artist=tracks[0].artist, album=tracks[0].album, track_uri=track_uri)
+        predict(track_uri, **changes)
+
+def queue_toggle_play():
+    now_playing = DATASTORE.now_playing
+    if not now_playing:
+        return
+    with prediction_lock:
+        playing = not now_playing['is_playing']
+        COMMANDS.play(playing)
+        track_uri = prediction['track_uri'] if prediction else now_playing['track_uri']
+        predict(track_uri, is_playing=playing, progress=current_progress(now_playing), timestamp=time.time())
 
 def pause():
-    global sleep_time
     sp.pause_playback()
-    sleep_time = 0.4
-    refresh_now_playing()
 
 def resume():
-    global sleep_time
     sp.start_playback()
-    sleep_time = 0.4
-    refresh_now_playing()
 
-def toggle_play():
-    now_playing = DATASTORE.now_playing
-    if not now_playing:
-        return
-    if now_playing['is_playing']:
-        pause()
-    else:
+def set_playing(playing):
+    if playing:
         resume()
+    else:
+        pause()
 
-def bg_loop():
-    global sleep_time
-    while True:
-        refresh_now_playing()
-        time.sleep(sleep_time)
-        sleep_time = min(4, sleep_time * 2)
+def poll_now_playing():
+    refresh_now_playing()
+    return DATASTORE.now_playing
 
-sleep_time = 0.3
-thread = threading.Thread(target=bg_loop, args=())
-thread.daemon = True                            # Daemonize thread
-thread.start()
+POLLER = poller.NowPlayingPoller(poll_now_playing)
+POLLER.start()
 
+# One-off background loads started from the UI, such as the next page of a
+# GrowingWindow. Playback goes through COMMANDS and search through LiveSearch.
 def run_async(fun):
     threading.Thread(target=fun, args=()).start()
+
+# Playback commands from the UI, one refresh per burst of presses
+COMMANDS = command_queue.CommandQueue(skip_tracks, set_playing, on_idle=POLLER.boost)
@@ -2,14 +2,17 @@
 # This is me learning Python as I go.
 # This is not how I write code for my day job.
 
+import time
+BOOT_START = time.perf_counter()
+
 import tkinter as tk 
 import socket
 import json
-import time
 from datetime import timedelta
 from select import select
 from tkinter import ttk
 from view_model import *
+VIEW_MODEL_READY = time.perf_counter()
 from PIL import ImageTk, Image
 from sys import platform
 import os
@@ -46,11 +49,13 @@ screen_on = True
 def screen_sleep():
     global screen_on
     screen_on = False
+    spotify_manager.POLLER.sleep()
     os.system('xset -display :0 dpms force off')
 
 def screen_wake():
     global screen_on
     screen_on = True
+    spotify_manager.POLLER.wake_up()
     os.system('xset -display :0 dpms force on')
 
 def flattenAlpha(img):
@@ -209,12 +214,19 @@ class SearchFrame(tk.Frame):
         search_line.grid(row = 3, column = 0, sticky ="we", pady=10, padx=120)
         self.loading_label = tk.Label(self, text ="", font = LARGEFONT, background=SPOT_BLACK, foreground=SPOT_WHITE) 
         self.loading_label.grid(row = 4, column = 0, sticky ="we", pady=(int(100 * SCALE), 0))
+        self.preview_labels = []
+        for i in range(SEARCH_PREVIEW_LINES):
+            label = tk.Label(self, text ="", font = MED_FONT, background=SPOT_BLACK, foreground=SPOT_WHITE, anchor="w")
+            label.grid(row = 5 + i, column = 0, sticky ="we", padx=120)
+            self.preview_labels.append(label)
 
-    def update_search(self, query, active_char, loading):
+    def update_search(self, query, active_char, loading, preview):
         self.query_label.configure(text=query)
         self.letter_label.configure(text=active_char)
         loading_text = "Loading..." if loading else ""
         self.loading_label.configure(text=loading_text)
+        for i, label in enumerate(self.preview_labels):
+            label.configure(text=preview[i] if i < len(preview) else "")
 
 class NowPlayingFrame(tk.Frame): 
     def __init__(self, parent, controller):  
@@ -463,7 +475,7 @@ def onKeyPress(event):
     else:
         print("unrecognized key: ", c)
 
-def update_search(q, ch, loading, results):
+def update_search(q, ch, loading, results, preview):
     global app, page
     search_page = app.frames[SearchFrame]
     if (results is not None):
@@ -471,7 +483,7 @@ def update_search(q, ch, loading, results):
         page = SearchResultsPage(page, results)
         render(app, page.render())
     else:
-        search_page.update_search(q, ch, loading)
+        search_page.update_search(q, ch, loading, preview)
 
 def render_search(app, search_render):
     app.show_frame(SearchFrame)
@@ -558,6 +570,13 @@ sock.setblocking(0)
 socket_list = [sock]
 loop_count = 0
 
+def report_startup():
+    first_menu = time.perf_counter()
+    print("startup: view model {:.0f} ms, first menu {:.0f} ms{}".format(
+        (VIEW_MODEL_READY - BOOT_START) * 1000.0,
+        (first_menu - BOOT_START) * 1000.0,
+        " (from library snapshot)" if spotify_manager.DATASTORE.using_snapshot else ""))
+
 def app_main_loop():
     global app, page, loop_count, last_interaction, screen_on
     try:
@@ -577,5 +596,6 @@ def app_main_loop():
         app.after(2, app_main_loop)
 
 app.bind('<KeyPress>', onKeyPress)
+app.after_idle(report_startup)
 app.after(5, app_main_loop)
 app.mainloop()
\ No newline at end of file
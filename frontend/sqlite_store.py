@@ -0,0 +1,205 @@
+import sqlite3
+import threading
+
+# Embedded alternative to redis-server for the Datastore. It implements the
+# subset of the redis-py client that datastore.py uses, on top of one SQLite
+# file with a table per Redis value type. Values and keys are returned as
+# bytes, like redis-py does without decode_responses.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS strings (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (key TEXT NOT NULL, field TEXT NOT NULL, value BLOB NOT NULL,
+    PRIMARY KEY (key, field)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sets (key TEXT NOT NULL, member TEXT NOT NULL,
+    PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lists (key TEXT NOT NULL, pos INTEGER NOT NULL, value BLOB NOT NULL,
+    PRIMARY KEY (key, pos)) WITHOUT ROWID;
+"""
+TABLES = ["strings", "hashes", "sets", "lists"]
+MMAP_BYTES = 64 * 1024 * 1024
+MAX_QUERY_ARGS = 500
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+def _blob(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+class SqliteStore():
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA mmap_size=" + str(MMAP_BYTES))
+        self.conn.executescript(SCHEMA)
+
+    def _query(self, sql, args = ()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def _write(self, sql, args = ()):
+        with self.lock:
+            return self.conn.execute(sql, args).rowcount
+
+    def ping(self):
+        return True
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def type(self, key):
+        for table, name in zip(TABLES, [b'string', b'hash', b'set', b'list']):
+            if self._query("SELECT 1 FROM " + table + " WHERE key = ? LIMIT 1", (_text(key),)):
+                return name
+        return b'none'
+
+    def pipeline(self, transaction = True):
+        return SqlitePipeline(self)
+
+    def get(self, key):
+        rows = self._query("SELECT value FROM strings WHERE key = ?", (_text(key),))
+        return rows[0][0] if rows else None
+
+    def mget(self, keys):
+        keys = [_text(key) for key in keys]
+        found = {}
+        for start in range(0, len(keys), MAX_QUERY_ARGS):
+            chunk = keys[start:start + MAX_QUERY_ARGS]
+            found.update(self._query("SELECT key, value FROM strings WHERE key IN (" +
+                ",".join("?" * len(chunk)) + ")", chunk))
+        return [found.get(key) for key in keys]
+
+    def set(self, key, value):
+        self._write("INSERT OR REPLACE INTO strings (key, value) VALUES (?, ?)", (_text(key), _blob(value)))
+        return True
+
+    def incr(self, key):
+        with self.lock:
+            value = int(self.get(key) or 0) + 1
+            self.set(key, value)
+            return value
+
+    def hget(self, key, field):
+        rows = self._query("SELECT value FROM hashes WHERE key = ? AND field = ?", (_text(key), _text(field)))
+        return rows[0][0] if rows else None
+
+    def hmget(self, key, fields):
+        fields = [_text(field) for field in fields]
+        rows = {}
+        for start in range(0, len(fields), MAX_QUERY_ARGS):
+            chunk = fields[start:start + MAX_QUERY_ARGS]
+            rows.update(self._query("SELECT field, value FROM hashes WHERE key = ? AND field IN (" +
+                ",".join("?" * len(chunk)) + ")", [_text(key)] + chunk))
+        return [rows.get(field) for field in fields]
+
+    def hset(self, key, field = None, value = None, mapping = None):
+        items = list(mapping.items()) if mapping else []
+        if field is not None:
+            items.append((field, value))
+        with self.lock:
+            return sum(self._write("INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)",
+                (_text(key), _text(field), _blob(value))) for field, value in items)
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            return sum(self._write("DELETE FROM hashes WHERE key = ? AND field = ?", (_text(key), _text(field)))
+                for field in fields)
+
+    def hlen(self, key):
+        return self._query("SELECT COUNT(*) FROM hashes WHERE key = ?", (_text(key),))[0][0]
+
+    def hgetall(self, key):
+        return {_blob(field): value for field, value in
+            self._query("SELECT field, value FROM hashes WHERE key = ?", (_text(key),))}
+
+    def sadd(self, key, *members):
+        with self.lock:
+            return sum(self._write("INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)",
+                (_text(key), _text(member))) for member in members)
+
+    def srem(self, key, *members):
+        with self.lock:
+            return sum(self._write("DELETE FROM sets WHERE key = ? AND member = ?", (_text(key), _text(member)))
+                for member in members)
+
+    def smembers(self, key):
+        return {_blob(member) for (member,) in self._query("SELECT member FROM sets WHERE key = ?", (_text(key),))}
+
+    def llen(self, key):
+        return self._query("SELECT COUNT(*) FROM lists WHERE key = ?", (_text(key),))[0][0]
+
+    def rpush(self, key, *values):
+        with self.lock:
+            start = self.llen(key)
+            self.conn.executemany("INSERT INTO lists (key, pos, value) VALUES (?, ?, ?)",
+                [(_text(key), start + idx, _blob(value)) for idx, value in enumerate(values)])
+            return start + len(values)
+
+    def lrange(self, key, start, stop):
+        # Inclusive bounds, negative values count from the end, as in Redis
+        if start < 0 or stop < 0:
+            length = self.llen(key)
+            start = max(0, start + length) if start < 0 else start
+            stop = stop + length if stop < 0 else stop
+        return [value for (value,) in self._query("SELECT value FROM lists WHERE key = ? AND pos BETWEEN ? AND ? ORDER BY pos",
+            (_text(key), start, stop))]
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self._write("DELETE FROM " + table + " WHERE key = ?", (_text(key),))
+                for key in keys for table in TABLES)
+
+    unlink = delete
+
+    def rename(self, src, dst):
+        with self.lock:
+            self.delete(dst)
+            for table in TABLES:
+                self._write("UPDATE " + table + " SET key = ? WHERE key = ?", (_text(dst), _text(src)))
+        return True
+
+    def keys(self, pattern = "*"):
+        # Redis glob patterns are close enough to SQLite's GLOB for our keys
+        found = set()
+        for table in TABLES:
+            found.update(key for (key,) in self._query("SELECT DISTINCT key FROM " + table + " WHERE key GLOB ?", (pattern,)))
+        return [_blob(key) for key in found]
+
+    def scan_iter(self, match = "*", count = None):
+        return iter(self.keys(match))
+
+    def flushdb(self):
+        with self.lock:
+            for table in TABLES:
+                self._write("DELETE FROM " + table)
+        return True
+
+class SqlitePipeline():
+    # Buffers commands and runs them in a single transaction on execute(),
+    # returning their results in order like a redis-py pipeline
+    def __init__(self, store):
+        self.store = store
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+        def buffer(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return buffer
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        with self.store.lock:
+            self.store.conn.execute("BEGIN")
+            try:
+                results = [command(*args, **kwargs) for command, args, kwargs in commands]
+            except:
+                self.store.conn.execute("ROLLBACK")
+                raise
+            self.store.conn.execute("COMMIT")
+        return results
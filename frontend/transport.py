@@ -0,0 +1,85 @@
+import random
+import threading
+import time
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# HTTP plumbing for the Spotify clients: keep-alive connection pools sized
+# for the threads that share them, (connect, read) timeouts on every call,
+# retries with jittered exponential backoff, and an access token that is
+# refreshed ahead of its expiry so no command has to wait on the OAuth
+# round trip.
+
+CONNECT_TIMEOUT = 3.05
+INTERACTIVE_TIMEOUT = (CONNECT_TIMEOUT, 5)
+BULK_TIMEOUT = (CONNECT_TIMEOUT, 15)
+RETRIES = 3
+BACKOFF_FACTOR = 0.3
+SERVER_ERRORS = (500, 502, 503, 504)
+RATE_LIMITED = 429
+# POST is left out: a retried next/previous could skip twice
+RETRY_METHODS = frozenset(['GET', 'PUT', 'DELETE'])
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_RETRY_SECONDS = 30
+
+class JitteredRetry(Retry):
+    # Full jitter: a random delay up to the exponential backoff, so threads
+    # that failed together don't retry together
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+def session(pool_size, retry_rate_limits = True):
+    retry = JitteredRetry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=False,
+        status=RETRIES,
+        allowed_methods=RETRY_METHODS,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=SERVER_ERRORS + ((RATE_LIMITED,) if retry_rate_limits else ()),
+        respect_retry_after_header=retry_rate_limits,
+        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    result = requests.Session()
+    result.mount('https://', adapter)
+    result.mount('http://', adapter)
+    return result
+
+def client(auth_manager, timeout, pool_size, retry_rate_limits = True):
+    return spotipy.Spotify(auth_manager=auth_manager, requests_timeout=timeout,
+        requests_session=session(pool_size, retry_rate_limits))
+
+class TokenRefresher():
+    """Refreshes the cached access token TOKEN_REFRESH_MARGIN seconds before
+    it expires, well before spotipy's own on-demand refresh kicks in."""
+    def __init__(self, auth_manager, margin = TOKEN_REFRESH_MARGIN):
+        self.auth_manager = auth_manager
+        self.margin = margin
+
+    def start(self):
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def next_delay(self):
+        token = self.auth_manager.cache_handler.get_cached_token()
+        if not token or 'refresh_token' not in token:
+            # Not logged in yet, spotipy handles the first authorization
+            return TOKEN_RETRY_SECONDS
+        delay = token['expires_at'] - self.margin - time.time()
+        if delay > 0:
+            return delay
+        try:
+            token = self.auth_manager.refresh_access_token(token['refresh_token'])
+            return max(TOKEN_RETRY_SECONDS, token['expires_at'] - self.margin - time.time())
+        except Exception as e:
+            print("token refresh failed: " + str(e))
+            return TOKEN_RETRY_SECONDS
+
+    def run(self):
+        while True:
+            delay = self.next_delay()
+            if delay > 0:
+                time.sleep(delay)
@@ -1,8 +1,19 @@
 import spotify_manager
+import live_search
 import re as re
+import time
 from functools import lru_cache 
+from collections import OrderedDict
 
 MENU_PAGE_SIZE = 6
+SEARCH_PREVIEW_LINES = 3
+# Extra rows fetched on either side of the visible menu page
+WINDOW_PREFETCH = MENU_PAGE_SIZE
+# How close to the end of a partly stored collection the cursor gets before
+# its next page is fetched
+LOAD_AHEAD = 2 * MENU_PAGE_SIZE
+LOAD_RETRY_SECONDS = 10
+PAGE_CACHE_SIZE = 15
 
 # Screen render types
 MENU_RENDER_TYPE = 0
@@ -14,7 +25,7 @@ LINE_NORMAL = 0
 LINE_HIGHLIGHT = 1
 LINE_TITLE = 2
 
-spotify_manager.refresh_devices()
+spotify_manager.run_startup_sync()
 
 class LineItem():
     def __init__(self, title = "", line_type = LINE_NORMAL, show_arrow = False):
@@ -74,7 +85,8 @@ class NowPlayingCommand():
     
     def run(self):
         self.has_run = True
-        self.runnable()
+        # Queued with the other playback commands so they apply in order
+        spotify_manager.COMMANDS.submit(self.runnable)
 
 class SearchRendering(Rendering):
     def __init__(self, query, active_char):
@@ -84,6 +96,7 @@ class SearchRendering(Rendering):
         self.loading = False
         self.callback = None
         self.results = None
+        self.preview = []
 
     def get_active_char(self):
         return ' ' if self.active_char == 26 else chr(self.active_char + ord('a'))
@@ -100,7 +113,7 @@ class SearchRendering(Rendering):
     def refresh(self):
         if not self.callback:
             return
-        self.callback(self.query, self.get_active_char(), self.loading, self.results)
+        self.callback(self.query, self.get_active_char(), self.loading, self.results, self.preview)
         self.results = None
 
     def unsubscribe(self):
@@ -108,6 +121,16 @@ class SearchRendering(Rendering):
         self.callback = None
         self.app = None
 
+def preview_lines(results):
+    # The best hit of each kind, tracks first
+    if results is None:
+        return []
+    lines = [track.title + " - " + track.artist for track in results.tracks[:1]]
+    lines += [artist.name for artist in results.artists[:1]]
+    lines += [album.name + " - " + album.artist for album in results.albums[:1]]
+    lines += [item.name for item in (results.playlists + results.shows)[:1]]
+    return lines[:SEARCH_PREVIEW_LINES]
+
 class SearchPage():
     def __init__(self, previous_page):
         self.header = "Search"
@@ -115,10 +138,25 @@ class SearchPage():
         self.previous_page = previous_page
         self.live_render = SearchRendering("", 0)
         self.is_title = False
+        # Completed searches as (query, results), the newest one last
+        self.last_results = None
+        self.open_seq = None
+        self.searcher = live_search.LiveSearch([spotify_manager.local_search, spotify_manager.search],
+            self.on_results)
+
+    def query_changed(self, picking):
+        # While a letter is being picked, search as if it was already added
+        self.open_seq = None
+        query = self.live_render.query + (self.live_render.get_active_char() if picking else "")
+        if query.strip():
+            self.searcher.update(query)
+        else:
+            self.live_render.preview = []
+        self.live_render.refresh()
 
     def nav_prev(self):
         self.live_render.query = self.live_render.query[0:-1]
-        self.live_render.refresh()
+        self.query_changed(False)
 
     def nav_next(self):
         if len(self.live_render.query) > 15:
@@ -126,7 +164,7 @@ class SearchPage():
         active_char = ' ' if self.live_render.active_char == 26 \
           else chr(self.live_render.active_char + ord('a')) 
         self.live_render.query += active_char
-        self.live_render.refresh()
+        self.query_changed(False)
 
     def nav_play(self):
         pass
@@ -135,23 +173,34 @@ class SearchPage():
         self.live_render.active_char += 1
         if (self.live_render.active_char > 26):
             self.live_render.active_char = 0
-        self.live_render.refresh()
+        self.query_changed(True)
 
     def nav_down(self):
         self.live_render.active_char -= 1
         if (self.live_render.active_char < 0):
             self.live_render.active_char = 26
-        self.live_render.refresh()
-
-    def run_search(self, query):
-        self.live_render.loading = True
-        self.live_render.refresh()
-        self.live_render.results = spotify_manager.search(query)
-        self.live_render.loading = False
+        self.query_changed(True)
+
+    def on_results(self, seq, query, results, done):
+        # Runs on the search worker, only for the newest query
+        self.live_render.preview = preview_lines(results)
+        if done:
+            self.last_results = (query, results)
+        if seq == self.open_seq:
+            self.live_render.loading = not done
+            if done:
+                self.open_seq = None
+                self.live_render.results = results
         self.live_render.refresh()
 
     def nav_select(self):
-        spotify_manager.run_async(lambda: self.run_search(self.live_render.query))
+        query = self.live_render.query
+        if self.last_results is not None and self.last_results[0] == query and self.last_results[1] is not None:
+            self.live_render.results = self.last_results[1]
+        elif query.strip():
+            self.open_seq = self.searcher.update(query, delay=0)
+            self.live_render.loading = True
+        self.live_render.refresh()
         return self
 
     def nav_back(self):
@@ -169,26 +218,17 @@ class NowPlayingPage():
         self.live_render = NowPlayingRendering()
         self.is_title = False
 
-    def play_previous(self):
-        spotify_manager.play_previous()
-        self.live_render.refresh()
-
-    def play_next(self):
-        spotify_manager.play_next()
-        self.live_render.refresh()
-
-    def toggle_play(self):
-        spotify_manager.toggle_play()
-        self.live_render.refresh()
-
     def nav_prev(self):
-        spotify_manager.run_async(lambda: self.play_previous()) 
+        spotify_manager.queue_skip(-1)
+        self.live_render.refresh()
 
     def nav_next(self):
-        spotify_manager.run_async(lambda: self.play_next()) 
+        spotify_manager.queue_skip(1)
+        self.live_render.refresh()
 
     def nav_play(self):
-        spotify_manager.run_async(lambda: self.toggle_play()) 
+        spotify_manager.queue_toggle_play()
+        self.live_render.refresh()
 
     def nav_up(self):
         pass
@@ -207,6 +247,96 @@ class NowPlayingPage():
             self.command.run()
         return self.live_render
 
+class ItemWindow():
+    # Caches a contiguous slice of a datastore collection around the cursor so
+    # that a render costs no round trips and a scroll step at most one.
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.start = 0
+        self.items = None
+        self.total = None
+        self.generation = None
+
+    def is_stale(self):
+        return self.items is None or self.generation != spotify_manager.DATASTORE.generation
+
+    def total_size(self):
+        if self.is_stale():
+            self.load(0)
+        return self.total
+
+    def load(self, index):
+        self.generation = spotify_manager.DATASTORE.generation
+        self.start = max(0, index - WINDOW_PREFETCH)
+        self.items, self.total = self.fetch(self.start, MENU_PAGE_SIZE + 2 * WINDOW_PREFETCH)
+
+    def item_at(self, index):
+        if self.is_stale() or not (self.start <= index < self.start + len(self.items)):
+            self.load(index)
+        offset = index - self.start
+        return self.items[offset] if offset < len(self.items) else None
+
+class GrowingWindow():
+    # A collection stored front to back as it is browsed: lists what is
+    # stored and has the next page fetched in the background once the
+    # cursor gets within LOAD_AHEAD items of its end.
+    def __init__(self, load, load_more):
+        # load() -> (stored items, total at Spotify or None), load_more()
+        # stores the next page and returns how many items it added
+        self.load = load
+        self.load_more = load_more
+        self.items = None
+        self.total = None
+        self.generation = None
+        self.loading = False
+        self.retry_at = 0
+
+    def _current(self):
+        items = self.items
+        if items is None or self.generation != spotify_manager.DATASTORE.generation:
+            self.generation = spotify_manager.DATASTORE.generation
+            items, self.total = self.load()
+            self.items = items
+        return items
+
+    def total_size(self):
+        return len(self._current())
+
+    def item_at(self, index):
+        items = self._current()
+        if index >= len(items) - LOAD_AHEAD:
+            self._grow(len(items))
+        return items[index] if index < len(items) else None
+
+    def _grow(self, count):
+        if self.loading or time.time() < self.retry_at or (self.total is not None and count >= self.total):
+            return
+        self.loading = True
+        def load_more():
+            try:
+                if self.load_more() == 0:
+                    # Spotify's total was off, stop asking
+                    self.total = count
+                else:
+                    self.items = None
+            except Exception as e:
+                print("loading more failed: " + str(e))
+                self.retry_at = time.time() + LOAD_RETRY_SECONDS
+            finally:
+                self.loading = False
+        spotify_manager.run_async(load_more)
+
+def cached_page(cache, uri, make):
+    # The item's page from an OrderedDict of the most recently used ones,
+    # keyed by uri since a reload of the list may move items around
+    page = cache.pop(uri, None)
+    if page is None:
+        page = make()
+    cache[uri] = page
+    while len(cache) > PAGE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return page
+
 EMPTY_LINE_ITEM = LineItem()
 class MenuPage():
     def __init__(self, header, previous_page, has_sub_page, is_title = False):
@@ -224,13 +354,13 @@ class MenuPage():
         return None
 
     def nav_prev(self):
-        spotify_manager.run_async(lambda: spotify_manager.play_previous()) 
+        spotify_manager.queue_skip(-1)
 
     def nav_next(self):
-        spotify_manager.run_async(lambda: spotify_manager.play_next()) 
+        spotify_manager.queue_skip(1)
 
     def nav_play(self):
-        spotify_manager.run_async(lambda: spotify_manager.toggle_play()) 
+        spotify_manager.queue_toggle_play()
     
     def get_index_jump_up(self):
         return 1
@@ -281,21 +411,24 @@ class MenuPage():
 class ShowsPage(MenuPage):
     def __init__(self, previous_page):
         super().__init__(self.get_title(), previous_page, has_sub_page=True)
-        self.shows = self.get_content()
-        self.num_shows = len(self.shows)
+        self.window = GrowingWindow(self.get_content, spotify_manager.load_more_shows)
+        self.show_pages = OrderedDict()
 
     def get_title(self):
         return "Podcasts"
     
     def get_content(self):
-        return spotify_manager.DATASTORE.getAllSavedShows()
+        datastore = spotify_manager.DATASTORE
+        return (datastore.getIndexedItems("show"), datastore.getCollectionTotal("show"))
 
     def total_size(self):
-        return self.num_shows
+        return self.window.total_size()
 
-    @lru_cache(maxsize=15)
     def page_at(self, index):
-        return SingleShowPage(self.shows[index], self)
+        show = self.window.item_at(index)
+        if show is None:
+            return None
+        return cached_page(self.show_pages, show.uri, lambda: SingleShowPage(show, self))
 
 class PlaylistsPage(MenuPage):
     def __init__(self, previous_page):
@@ -338,38 +471,51 @@ class SearchResultsPage(MenuPage):
     def __init__(self, previous_page, results):
         super().__init__("Search Results", previous_page, has_sub_page=True)
         self.results = results
-        tracks, albums, artists = len(results.tracks), len(results.albums), len(results.artists)
-        # Add 1 to each count (if > 0) to make room for section header line items 
-        self.tracks = tracks + 1 if tracks > 0 else 0
-        self.artists = artists + 1 if artists > 0 else 0
-        self.albums = albums + 1 if albums > 0 else 0
-        self.total_count = self.tracks + self.albums + self.artists
+        sections = [("TRACKS", results.tracks, self.track_page), ("ARTISTS", results.artists, self.artist_page),
+            ("ALBUMS", results.albums, self.album_page), ("PLAYLISTS", results.playlists, self.playlist_page),
+            ("PODCASTS", results.shows, self.show_page)]
+        # Each non-empty section is preceded by a header line item
+        self.sections = []
+        self.header_indices = []
+        self.total_count = 0
+        for title, items, page_for in sections:
+            if len(items) == 0:
+                continue
+            self.header_indices.append(self.total_count)
+            self.sections.append((self.total_count, title, items, page_for))
+            self.total_count += len(items) + 1
         self.index = 1
-        # indices of the section header line items
-        self.header_indices = [0, self.tracks, self.artists + self.tracks]
 
     def total_size(self):
         return self.total_count
 
+    def track_page(self, track):
+        command = NowPlayingCommand(lambda: spotify_manager.play_track(track.uri))
+        return NowPlayingPage(self, track.title, command)
+
+    def artist_page(self, artist):
+        command = NowPlayingCommand(lambda: spotify_manager.play_artist(artist.uri))
+        return NowPlayingPage(self, artist.name, command)
+
+    def album_page(self, album):
+        if album.uri in self.results.album_track_map:
+            return SearchAlbumPage(album, self.results, self)
+        # In the library
+        return SinglePlaylistPage(album, self)
+
+    def playlist_page(self, playlist):
+        return SinglePlaylistPage(playlist, self)
+
+    def show_page(self, show):
+        return SingleShowPage(show, self)
+
     def page_at(self, index):
-        if self.tracks > 0 and index == 0:
-            return PlaceHolderPage("TRACKS", self, has_sub_page=False, is_title=True)
-        elif self.artists > 0 and index == self.header_indices[1]:
-            return PlaceHolderPage("ARTISTS", self, has_sub_page=False, is_title=True)
-        elif self.albums > 0 and index == self.header_indices[2]:
-            return PlaceHolderPage("ALBUMS", self, has_sub_page=False, is_title=True)
-        elif self.tracks > 0 and  index < self.header_indices[1]:
-            track = self.results.tracks[index - 1]
-            command = NowPlayingCommand(lambda: spotify_manager.play_track(track.uri))
-            return NowPlayingPage(self, track.title, command)
-        elif self.albums > 0 and  index < self.header_indices[2]:
-            artist = self.results.artists[index - (self.tracks + 1)]
-            command = NowPlayingCommand(lambda: spotify_manager.play_artist(artist.uri))
-            return NowPlayingPage(self, artist.name, command)
-        else:
-            album = self.results.albums[index - (self.artists + self.tracks + 1)]
-            tracks = self.results.album_track_map[album.uri]
-            return InMemoryPlaylistPage(album, tracks, self)
+        for start, title, items, page_for in reversed(self.sections):
+            if index == start:
+                return PlaceHolderPage(title, self, has_sub_page=False, is_title=True)
+            if index > start:
+                return page_for(items[index - start - 1])
+        return None
 
     def get_index_jump_up(self):
         if self.index + 1 in self.header_indices:
@@ -381,26 +527,41 @@ class SearchResultsPage(MenuPage):
             return 2
         return 1
 
-class NewReleasesPage(PlaylistsPage):
+class NewReleasesPage(MenuPage):
     def __init__(self, previous_page):
-        super().__init__(previous_page)
+        super().__init__(self.get_title(), previous_page, has_sub_page=True)
+        self.window = GrowingWindow(self.get_content, spotify_manager.load_more_new_releases)
+        self.album_pages = OrderedDict()
 
     def get_title(self):
         return "New Releases"
 
     def get_content(self):
-        return spotify_manager.DATASTORE.getAllNewReleases()
+        datastore = spotify_manager.DATASTORE
+        return (datastore.getIndexedItems("nr"), datastore.getCollectionTotal("nr"))
+
+    def total_size(self):
+        return self.window.total_size()
+
+    def page_at(self, index):
+        album = self.window.item_at(index)
+        if album is None:
+            return None
+        return cached_page(self.album_pages, album.uri, lambda: SinglePlaylistPage(album, self))
 
 class ArtistsPage(MenuPage):
     def __init__(self, previous_page):
         super().__init__("Artists", previous_page, has_sub_page=True)
+        self.window = ItemWindow(spotify_manager.DATASTORE.getArtists)
 
     def total_size(self):
-        return spotify_manager.DATASTORE.getArtistCount()
+        return self.window.total_size()
 
     def page_at(self, index):
         # play track
-        artist = spotify_manager.DATASTORE.getArtist(index)
+        artist = self.window.item_at(index)
+        if artist is None:
+            return None
         command = NowPlayingCommand(lambda: spotify_manager.play_artist(artist.uri))
         return NowPlayingPage(self, artist.name, command)
     
@@ -420,18 +581,18 @@ class SinglePlaylistPage(MenuPage):
 
         super().__init__(regex_pattern.sub(r'',playlist.name), previous_page, has_sub_page=True)
         self.playlist = playlist
-        self.tracks = None
+        self.window = ItemWindow(self.get_tracks)
 
-    def get_tracks(self):
-        if self.tracks is None:
-            self.tracks = spotify_manager.DATASTORE.getPlaylistTracks(self.playlist.uri)
-        return self.tracks
+    def get_tracks(self, start, count):
+        return spotify_manager.DATASTORE.getPlaylistTrackRange(self.playlist.uri, start, count)
 
     def total_size(self):
         return self.playlist.track_count
 
     def page_at(self, index):
-        track = self.get_tracks()[index]
+        track = self.window.item_at(index)
+        if track is None:
+            return None
         command = NowPlayingCommand(lambda: spotify_manager.play_from_playlist(self.playlist.uri, track.uri, None))
         return NowPlayingPage(self, track.title, command)
 
@@ -439,18 +600,18 @@ class SingleShowPage(MenuPage):
     def __init__(self, show, previous_page):
         super().__init__(show.name, previous_page, has_sub_page=True)
         self.show = show
-        self.episodes = None
+        self.window = GrowingWindow(self.get_episodes, lambda: spotify_manager.load_more_episodes(show))
 
     def get_episodes(self):
-        if self.episodes is None:
-            self.episodes = spotify_manager.DATASTORE.getShowEpisodes(self.show.uri)
-        return self.episodes
+        return (spotify_manager.DATASTORE.getShowEpisodes(self.show.uri) or [], self.show.episode_count)
 
     def total_size(self):
-        return self.show.episode_count
+        return self.window.total_size()
 
     def page_at(self, index):
-        episode = self.get_episodes()[index]
+        episode = self.window.item_at(index)
+        if episode is None:
+            return None
         command = NowPlayingCommand(lambda: spotify_manager.play_from_show(self.show.uri, episode.uri, None))
         return NowPlayingPage(self, episode.name, command)
 
@@ -459,6 +620,39 @@ class InMemoryPlaylistPage(SinglePlaylistPage):
         super().__init__(playlist, previous_page)
         self.tracks = tracks
 
+    def get_tracks(self, start, count):
+        return (self.tracks[start:start + count], len(self.tracks))
+
+class SearchAlbumPage(InMemoryPlaylistPage):
+    # An album found by search outside the library. Its tracks are fetched
+    # in the background once the album is opened, and show as empty rows
+    # until they arrive.
+    def __init__(self, album, results, previous_page):
+        super().__init__(album, None, previous_page)
+        self.results = results
+        self.loading = False
+        self.retry_at = 0
+
+    def _load(self):
+        if self.loading or time.time() < self.retry_at:
+            return
+        self.loading = True
+        def load():
+            try:
+                tracks = spotify_manager.search_album_tracks(self.results, self.playlist)
+                if tracks is None:
+                    self.retry_at = time.time() + LOAD_RETRY_SECONDS
+                self.tracks = tracks
+            finally:
+                self.loading = False
+        spotify_manager.run_async(load)
+
+    def get_tracks(self, start, count):
+        if self.tracks is None:
+            self._load()
+            return ([], self.playlist.track_count)
+        return super().get_tracks(start, count)
+
 class SingleTrackPage(MenuPage):
     def __init__(self, track, previous_page, playlist = None, album = None):
         super().__init__(track.title, previous_page, has_sub_page=False)
@@ -491,11 +685,15 @@ class SavedTracksPage(MenuPage):
         super().__init__("Saved Tracks", previous_page, has_sub_page=True)
 
     def total_size(self):
-        return spotify_manager.DATASTORE.getSavedTrackCount()
+        return spotify_manager.SAVED_TRACKS.total_size()
 
     def page_at(self, index):
         # play track
-        return SingleTrackPage(spotify_manager.DATASTORE.getSavedTrack(index), self)
+        track = spotify_manager.SAVED_TRACKS.item_at(index)
+        if track is None:
+            return None
+        command = NowPlayingCommand(lambda: spotify_manager.play_track(track.uri))
+        return NowPlayingPage(self, track.title, command)
 
 class PlaceHolderPage(MenuPage):
     def __init__(self, header, previous_page, has_sub_page=True, is_title = False):
@@ -509,6 +707,7 @@ class RootPage(MenuPage):
             AlbumsPage(self),
             NewReleasesPage(self),
             PlaylistsPage(self),
+            SavedTracksPage(self),
             ShowsPage(self),
             SearchPage(self),
             NowPlayingPage(self, "Now Playing", NowPlayingCommand())